@@ -0,0 +1,298 @@
+# Локальная замена портала newamelia.mvideo.ru для нагрузочных тестов main.py.
+# Воспроизводит ровно ту разметку, на которую опирается сценарий: форму входа (#login-input,
+# #password-input, кнопка "Войти"), #nav-dynamic_issues, индикатор q-skeleton, таблицу заявок
+# с поиском, смену статуса "Прибыл на объект", вкладку "Комментарии" с #file-field-images
+# и уведомление "Запись успешно обновлена". Те же данные доступны через /api/* для AMELIA_API_MODE.
+#
+# Заявки с номером, начинающимся на "0", не существуют; начинающиеся на "9" находятся "в работе".
+#
+#   python bench/amelia_stub.py --port 8100 --latency-ms 150
+
+import argparse
+import secrets
+import threading
+import time
+
+from flask import Flask, jsonify, make_response, redirect, request
+
+app = Flask(__name__)
+
+LATENCY_SECONDS = 0.0
+SESSION_TTL_SECONDS = 0.0
+USERNAME = "bench"
+PASSWORD = "bench"
+
+_lock = threading.Lock()
+_sessions = {}  # token -> время создания
+_statuses = {}  # номер заявки -> статус, если он менялся
+_stats = {"logins": 0, "searches": 0, "uploads": 0, "files": 0, "status_changes": 0}
+
+_PIXEL = "data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"
+
+LOGIN_PAGE = """<!doctype html>
+<html lang="ru"><head><meta charset="utf-8"><title>Амелия - вход</title></head>
+<body>
+  <form id="login-form" onsubmit="return false">
+    <input id="login-input" type="text" aria-label="Логин">
+    <input id="password-input" type="password" aria-label="Пароль">
+    <button type="button" id="login-button">Войти</button>
+  </form>
+  <script>
+    document.getElementById("login-button").addEventListener("click", async () => {
+      const response = await fetch("/api/login", {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({
+          username: document.getElementById("login-input").value,
+          password: document.getElementById("password-input").value,
+        }),
+      });
+      if (response.ok) {
+        localStorage.setItem("token", (await response.json()).token);
+        location.href = "/";
+      }
+    });
+  </script>
+</body></html>
+"""
+
+APP_PAGE = """<!doctype html>
+<html lang="ru"><head><meta charset="utf-8"><title>Амелия</title>
+<style>
+  .q-skeleton { height: 16px; background: #ddd; }
+  td, th { padding: 8px 16px; }
+  #card { position: fixed; top: 40px; left: 40px; right: 40px; background: #fff; border: 1px solid #999; padding: 16px; }
+  #file-field-images { min-height: 40px; border: 1px dashed #999; }
+  .form-card-close-icon { cursor: pointer; float: right; padding: 4px 8px; }
+  #toast { position: fixed; bottom: 16px; right: 16px; background: #2a2; color: #fff; padding: 8px; }
+</style></head>
+<body>
+  <nav><div id="nav-dynamic_issues"><img alt="Заявки" src="PIXEL" width="24" height="24"></div></nav>
+  <main id="issues" hidden>
+    <div class="toolbar"><input id="search" type="text" aria-label="Поиск" placeholder="Поиск"></div>
+    <div class="title">Заявки</div>
+    <div id="loader"><div class="q-skeleton q-mb-sm"></div></div>
+    <table><thead><tr><th>Номер</th><th>Статус</th><th></th></tr></thead><tbody id="rows"></tbody></table>
+    <div id="status-actions"></div>
+  </main>
+  <div id="card" role="dialog" hidden>
+    <span class="form-card-close-icon">&times;</span>
+    <div role="tablist"><div role="tab" tabindex="0">Основное</div><div role="tab" tabindex="0" id="comments-tab">Комментарии</div></div>
+    <div id="comments" hidden>
+      <div id="file-field-images"><input type="file" multiple></div>
+      <div id="captions"></div>
+      <button type="button" id="add-button">Добавить</button>
+    </div>
+  </div>
+  <div id="toast" hidden>Запись успешно обновлена</div>
+  <script>
+    const $ = (selector) => document.querySelector(selector);
+    const headers = () => ({"Authorization": "Bearer " + localStorage.getItem("token")});
+    let currentIssue = null;
+    let searchTimer = null;
+
+    async function loadIssues(query) {
+      const response = await fetch("/api/issues?search=" + encodeURIComponent(query), {headers: headers()});
+      if (response.status === 401) { location.href = "/login"; return; }
+      const rows = $("#rows");
+      rows.innerHTML = "";
+      for (const issue of (await response.json()).items) {
+        const row = document.createElement("tr");
+        row.innerHTML = `<td class="number">${issue.number}</td><td class="status">${issue.status}</td>` +
+          `<td><img class="status-menu" alt="Статус" src="PIXEL" width="16" height="16"></td>`;
+        row.querySelector(".number").addEventListener("click", () => openCard(issue));
+        row.querySelector(".status-menu").addEventListener("click", () => openStatusMenu(issue, row));
+        rows.appendChild(row);
+      }
+    }
+
+    $("#nav-dynamic_issues").addEventListener("click", async () => {
+      $("#issues").hidden = false;
+      $("#loader").hidden = false;
+      await loadIssues("");
+      $("#loader").hidden = true;
+    });
+
+    $("#search").addEventListener("input", () => {
+      clearTimeout(searchTimer);
+      searchTimer = setTimeout(() => loadIssues($("#search").value), 150);
+    });
+
+    function openStatusMenu(issue, row) {
+      const actions = $("#status-actions");
+      actions.innerHTML = "";
+      const item = document.createElement("div");
+      item.className = "menu-item";
+      item.textContent = "Прибыл на объект";
+      item.addEventListener("click", () => {
+        item.remove();
+        const button = document.createElement("button");
+        button.type = "button";
+        button.textContent = "Прибыл на объект";
+        button.addEventListener("click", async () => {
+          await fetch(`/api/issues/${issue.id}/status`, {method: "POST", headers: headers()});
+          button.remove();
+          row.querySelector(".status").textContent = "прибыл на объект";
+        });
+        actions.appendChild(button);
+      });
+      actions.appendChild(item);
+    }
+
+    function openCard(issue) {
+      currentIssue = issue;
+      $("#comments").hidden = true;
+      $("#captions").innerHTML = "";
+      $("#card").hidden = false;
+    }
+
+    $("#comments-tab").addEventListener("click", () => { $("#comments").hidden = false; });
+
+    $('input[type="file"]').addEventListener("change", (event) => {
+      for (const file of event.target.files) {
+        const caption = document.createElement("span");
+        caption.className = "caption";
+        caption.textContent = file.name;
+        $("#captions").appendChild(caption);
+      }
+    });
+
+    $("#add-button").addEventListener("click", async () => {
+      const form = new FormData();
+      for (const file of $('input[type="file"]').files) form.append("images", file);
+      const response = await fetch(`/api/issues/${currentIssue.id}/comments`, {method: "POST", body: form, headers: headers()});
+      if (response.ok) {
+        $("#toast").hidden = false;
+        setTimeout(() => { $("#toast").hidden = true; }, 3000);
+      }
+    });
+
+    $(".form-card-close-icon").addEventListener("click", () => {
+      $("#card").hidden = true;
+      $('input[type="file"]').value = "";
+    });
+  </script>
+</body></html>
+""".replace("PIXEL", _PIXEL)
+
+
+def _delay():
+    if LATENCY_SECONDS:
+        time.sleep(LATENCY_SECONDS)
+
+
+def _authorized() -> bool:
+    token = request.cookies.get("stub_session")
+    auth = request.headers.get("Authorization", "")
+    if not token and auth.startswith("Bearer "):
+        token = auth[len("Bearer "):]
+    with _lock:
+        created = _sessions.get(token)
+    if created is None:
+        return False
+    return not SESSION_TTL_SECONDS or time.time() - created < SESSION_TTL_SECONDS
+
+
+def _issue(number: str) -> dict:
+    if number.startswith("9"):
+        default_status = "в работе"
+    else:
+        default_status = "новая"
+    with _lock:
+        status = _statuses.get(number, default_status)
+    return {"id": int(number), "number": number, "status": status}
+
+
+@app.route("/login")
+def login_page():
+    return LOGIN_PAGE
+
+
+@app.route("/")
+def app_page():
+    if not _authorized():
+        return redirect("/login")
+    return APP_PAGE
+
+
+@app.route("/api/login", methods=["POST"])
+def api_login():
+    _delay()
+    data = request.get_json(silent=True) or {}
+    if data.get("username") != USERNAME or data.get("password") != PASSWORD:
+        return jsonify({"error": "invalid credentials"}), 401
+    token = secrets.token_hex(16)
+    with _lock:
+        _sessions[token] = time.time()
+        _stats["logins"] += 1
+    response = make_response(jsonify({"token": token}))
+    response.set_cookie("stub_session", token, httponly=True)
+    return response
+
+
+@app.route("/api/issues")
+def api_issues():
+    if not _authorized():
+        return jsonify({"error": "unauthorized"}), 401
+    _delay()
+    query = request.args.get("search", "").strip()
+    with _lock:
+        _stats["searches"] += 1
+    if not query:
+        # Начальный список: несколько заявок, чтобы таблица не была пустой до поиска
+        return jsonify({"items": [_issue(str(number)) for number in range(100001, 100011)]})
+    if len(query) != 6 or not query.isdigit() or query.startswith("0"):
+        return jsonify({"items": []})
+    return jsonify({"items": [_issue(query)]})
+
+
+@app.route("/api/issues/<int:issue_id>/status", methods=["POST"])
+def api_status(issue_id):
+    if not _authorized():
+        return jsonify({"error": "unauthorized"}), 401
+    _delay()
+    with _lock:
+        _statuses[f"{issue_id:06d}"] = "прибыл на объект"
+        _stats["status_changes"] += 1
+    return jsonify({"ok": True})
+
+
+@app.route("/api/issues/<int:issue_id>/comments", methods=["POST"])
+def api_comments(issue_id):
+    if not _authorized():
+        return jsonify({"error": "unauthorized"}), 401
+    _delay()
+    files = request.files.getlist("images")
+    if not files:
+        return jsonify({"error": "no files"}), 400
+    with _lock:
+        _stats["uploads"] += 1
+        _stats["files"] += len(files)
+    return jsonify({"ok": True, "issue_id": issue_id, "files": [f.filename for f in files]})
+
+
+@app.route("/_stub/stats")
+def stub_stats():
+    with _lock:
+        return jsonify(dict(_stats))
+
+
+@app.route("/_stub/reset", methods=["POST"])
+def stub_reset():
+    with _lock:
+        for key in _stats:
+            _stats[key] = 0
+        _statuses.clear()
+    return jsonify({"ok": True})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Amelia portal")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=0, help="artificial latency of every /api call")
+    parser.add_argument("--session-ttl", type=float, default=0, help="session lifetime in seconds (0 - forever)")
+    args = parser.parse_args()
+    LATENCY_SECONDS = args.latency_ms / 1000
+    SESSION_TTL_SECONDS = args.session_ttl
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,313 @@
+# Нагрузочный тест main.py без продового портала и бакета.
+# Поднимает bench/amelia_stub.py, bench/s3_stub.py и main.py на локальных портах, заливает
+# в заглушку S3 тестовые файлы и отправляет конкурентные запросы /run_autoclicker.
+# Печатает (и при --output сохраняет) JSON с p50/p95/p99 задержки, задачами в минуту и
+# пиковым RSS процессов Chromium. Пороги --max-p95 / --min-tasks-per-minute / --max-rss-mb
+# делают код возврата ненулевым - так изменения производительности проверяются в CI.
+# Прогон без единого успешного запроса или с ошибками сверх --max-error-rate (по умолчанию 0)
+# тоже неуспешен: ответы 400 для несуществующих заявок ошибками не считаются.
+#
+#   python bench/load_test.py --requests 50 --concurrency 4 --latency-ms 100
+#   python bench/load_test.py --mode async --api-mode --output bench_result.json --max-p95 5
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN_PATH = os.path.join(os.path.dirname(BENCH_DIR), "main.py")
+BUCKET = "bench"
+
+
+def _http(method: str, url: str, payload=None, data: bytes = None, timeout: float = 600) -> tuple:
+    headers = {}
+    if payload is not None:
+        data = json.dumps(payload).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode} before {url} became ready")
+        try:
+            _http("GET", url, timeout=2)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready in {timeout} seconds")
+
+
+def _percentile(values: list, percent: float) -> float:
+    # nearest-rank
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _read_proc(pid: int, name: str) -> str:
+    with open(f"/proc/{pid}/{name}", "rb") as f:
+        return f.read().decode("utf-8", "replace")
+
+
+def _chromium_rss_mb(root_pid: int) -> float:
+    # Суммарный RSS процессов Chromium - потомков main.py (через /proc, только Linux)
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = _read_proc(int(entry), "stat")
+        except OSError:
+            continue
+        parents[int(entry)] = int(stat.rsplit(")", 1)[1].split()[1])
+
+    total_kb = 0
+    for pid in parents:
+        ancestor = parents.get(pid)
+        while ancestor and ancestor != root_pid:
+            ancestor = parents.get(ancestor)
+        if ancestor != root_pid:
+            continue
+        try:
+            cmdline = _read_proc(pid, "cmdline")
+            if "chrom" not in cmdline and "headless_shell" not in cmdline:
+                continue
+            for line in _read_proc(pid, "status").splitlines():
+                if line.startswith("VmRSS:"):
+                    total_kb += int(line.split()[1])
+                    break
+        except OSError:
+            continue
+    return total_kb / 1024
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, root_pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.peak_mb = max(self.peak_mb, _chromium_rss_mb(self.root_pid))
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _claim_number(args) -> str:
+    roll = random.random()
+    if roll < args.not_found_share:
+        return str(random.randint(0, 99999)).zfill(6)
+    if roll < args.not_found_share + args.in_work_share:
+        return str(random.randint(900000, 999999))
+    return str(random.randint(100000, 899999))
+
+
+def _run_one(args, main_url: str, s3_file_key: str, index: int) -> tuple:
+    payload = {"s3_file_key": s3_file_key, "identifier": f"bench-{index}"}
+    started = time.perf_counter()
+    if args.mode == "sync":
+        status, _ = _http("POST", f"{main_url}/run_autoclicker", payload)
+        return status, time.perf_counter() - started
+
+    payload["async"] = True
+    status, body = _http("POST", f"{main_url}/run_autoclicker", payload)
+    if status != 202:
+        return status, time.perf_counter() - started
+    job_id = json.loads(body)["job_id"]
+    while True:
+        status, _ = _http("GET", f"{main_url}/jobs/{job_id}/result")
+        if status != 202:
+            return status, time.perf_counter() - started
+        time.sleep(0.1)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline load test for main.py")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--latency-ms", type=float, default=100, help="artificial latency of the portal stand-in")
+    parser.add_argument("--s3-latency-ms", type=float, default=20, help="artificial latency of the S3 stand-in")
+    parser.add_argument("--claims", type=int, default=10, help="number of distinct claims in the data set")
+    parser.add_argument("--in-work-share", type=float, default=0.2,
+                        help="share of claims that are 'в работе' and need the status change (numbers starting with 9)")
+    parser.add_argument("--not-found-share", type=float, default=0.1,
+                        help="share of claims that do not exist in the portal (numbers starting with 0, answered with 400)")
+    parser.add_argument("--file-kb", type=int, default=200, help="size of each test file")
+    parser.add_argument("--api-mode", action="store_true", help="enable AMELIA_API_MODE in main.py")
+    parser.add_argument("--base-port", type=int, default=8100)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--max-p95", type=float, help="fail if p95 latency (seconds) is higher")
+    parser.add_argument("--min-tasks-per-minute", type=float, help="fail if throughput is lower")
+    parser.add_argument("--max-rss-mb", type=float, help="fail if peak Chromium RSS is higher")
+    parser.add_argument("--max-error-rate", type=float, default=0.0,
+                        help="fail if the share of unexpected responses (anything but 200 and the expected 400s) "
+                             "is higher; 1 disables the check")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-workdir", action="store_true", help="keep the temporary directory with debug.log")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    portal_port, s3_port, main_port = args.base_port, args.base_port + 100, args.base_port + 200
+    portal_url = f"http://127.0.0.1:{portal_port}"
+    s3_url = f"http://127.0.0.1:{s3_port}"
+    main_url = f"http://127.0.0.1:{main_port}"
+    workdir = tempfile.mkdtemp(prefix="ameliya-bench-")
+
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(main_port),
+        "AMELIA_BASE_URL": portal_url,
+        "LOGIN_USERNAME": "bench",
+        "LOGIN_PASSWORD": "bench",
+        "AWS_S3_ENDPOINT_URL": s3_url,
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "S3_BUCKET_NAME": BUCKET,
+        "SESSION_STATE_PATH": os.path.join(workdir, "session_state.json"),
+    })
+    if args.api_mode:
+        env.update({
+            "AMELIA_API_MODE": "1",
+            "AMELIA_API_ISSUES_URL": "/api/issues",
+            "AMELIA_API_ATTACH_URL": "/api/issues/{issue_id}/comments",
+            "AMELIA_API_TOKEN_STORAGE_KEY": "token",
+        })
+
+    processes = []
+    try:
+        portal = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, "amelia_stub.py"), "--port", str(portal_port),
+             "--latency-ms", str(args.latency_ms)],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        processes.append(portal)
+        s3 = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, "s3_stub.py"), "--port", str(s3_port),
+             "--latency-ms", str(args.s3_latency_ms)],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        processes.append(s3)
+        _wait_ready(f"{portal_url}/_stub/stats", portal)
+        _wait_ready(f"{s3_url}/_stub/stats", s3)
+
+        # Тестовые файлы: имя начинается с номера заявки, как у реальных фото.
+        # Первая цифра номера задаёт поведение заглушки: 9 - "в работе", 0 - заявки нет, иначе обычная
+        claims = [_claim_number(args) for _ in range(args.claims)]
+        keys = []
+        for index in range(args.requests):
+            key = f"bench/{random.choice(claims)}_{index}.jpg"
+            _http("PUT", f"{s3_url}/{BUCKET}/{key}", data=os.urandom(args.file_kb * 1024))
+            keys.append(key)
+        expected_not_found = sum(1 for key in keys if os.path.basename(key).startswith("0"))
+
+        # main.py пишет debug.log в текущую директорию - запускаем его во временной
+        app = subprocess.Popen([sys.executable, MAIN_PATH], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(app)
+        _wait_ready(f"{main_url}/stats", app)
+
+        sampler = RssSampler(app.pid)
+        sampler.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            outcomes = list(executor.map(lambda item: _run_one(args, main_url, item[1], item[0]), enumerate(keys)))
+        wall_seconds = time.perf_counter() - started
+        sampler.stop()
+
+        latencies = [latency for _, latency in outcomes]
+        status_codes = {}
+        for status, _ in outcomes:
+            status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+        succeeded = status_codes.get("200", 0)
+        report = {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "mode": args.mode,
+            "api_mode": args.api_mode,
+            "portal_latency_ms": args.latency_ms,
+            "succeeded": succeeded,
+            "failed": args.requests - succeeded,
+            # Всё, кроме 200 и ожидаемых 400 для несуществующих заявок
+            "unexpected": args.requests - succeeded - min(status_codes.get("400", 0), expected_not_found),
+            # Файлы несуществующих заявок: для них 400 - правильный ответ
+            "expected_not_found": expected_not_found,
+            "in_work_claims": sum(1 for claim in claims if claim.startswith("9")),
+            "status_codes": status_codes,
+            "latency_seconds": {
+                "p50": round(_percentile(latencies, 50), 3),
+                "p95": round(_percentile(latencies, 95), 3),
+                "p99": round(_percentile(latencies, 99), 3),
+                "mean": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+                "max": round(max(latencies), 3) if latencies else 0.0,
+            },
+            "wall_seconds": round(wall_seconds, 3),
+            "tasks_per_minute": round(succeeded / wall_seconds * 60, 2) if wall_seconds else 0.0,
+            "peak_chromium_rss_mb": round(sampler.peak_mb, 1),
+            "portal": json.loads(_http("GET", f"{portal_url}/_stub/stats")[1]),
+            "app": json.loads(_http("GET", f"{main_url}/stats")[1]),
+        }
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.keep_workdir:
+            print(f"Working directory kept: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failures = []
+    if report["succeeded"] == 0:
+        failures.append("no request succeeded")
+    error_rate = report["unexpected"] / args.requests if args.requests else 0.0
+    if error_rate > args.max_error_rate:
+        failures.append(f"error rate {error_rate:.2%} > {args.max_error_rate:.2%} (status codes: {report['status_codes']})")
+    if args.max_p95 is not None and report["latency_seconds"]["p95"] > args.max_p95:
+        failures.append(f"p95 {report['latency_seconds']['p95']}s > {args.max_p95}s")
+    if args.min_tasks_per_minute is not None and report["tasks_per_minute"] < args.min_tasks_per_minute:
+        failures.append(f"{report['tasks_per_minute']} tasks/min < {args.min_tasks_per_minute}")
+    if args.max_rss_mb is not None and report["peak_chromium_rss_mb"] > args.max_rss_mb:
+        failures.append(f"peak Chromium RSS {report['peak_chromium_rss_mb']} MB > {args.max_rss_mb} MB")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# Минимальная S3-совместимая заглушка (path-style) для нагрузочных тестов main.py.
+# Поддерживает ровно то, что использует main.py: PUT/HEAD/GET объекта, ETag, If-Match и Range.
+# Подпись запросов не проверяется. Подключается через AWS_S3_ENDPOINT_URL.
+#
+#   python bench/s3_stub.py --port 8200 --latency-ms 30
+
+import argparse
+import hashlib
+import threading
+import time
+from email.utils import formatdate
+
+from flask import Flask, Response, request
+
+app = Flask(__name__)
+
+LATENCY_SECONDS = 0.0
+
+_lock = threading.Lock()
+_objects = {}  # (bucket, key) -> (data, etag, last_modified)
+_stats = {"puts": 0, "heads": 0, "gets": 0, "bytes_sent": 0}
+
+
+def _error(status: int, code: str, message: str) -> Response:
+    body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{message}</Message></Error>'
+    return Response(body, status=status, mimetype="application/xml")
+
+
+@app.route("/<bucket>/<path:key>", methods=["PUT"])
+def put_object(bucket, key):
+    data = request.get_data()
+    etag = f'"{hashlib.md5(data).hexdigest()}"'
+    with _lock:
+        _objects[(bucket, key)] = (data, etag, time.time())
+        _stats["puts"] += 1
+    return Response(status=200, headers={"ETag": etag})
+
+
+@app.route("/<bucket>/<path:key>", methods=["GET", "HEAD"])
+def get_object(bucket, key):
+    if LATENCY_SECONDS:
+        time.sleep(LATENCY_SECONDS)
+    with _lock:
+        stored = _objects.get((bucket, key))
+        _stats["heads" if request.method == "HEAD" else "gets"] += 1
+    if stored is None:
+        if request.method == "HEAD":
+            return Response(status=404)
+        return _error(404, "NoSuchKey", "The specified key does not exist.")
+    data, etag, last_modified = stored
+
+    if_match = request.headers.get("If-Match")
+    if if_match and if_match.strip() not in (etag, etag.strip('"'), "*"):
+        return _error(412, "PreconditionFailed", "At least one of the pre-conditions you specified did not hold")
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+    status = 200
+    range_header = request.headers.get("Range")
+    if range_header and range_header.startswith("bytes="):
+        start, _, end = range_header[len("bytes="):].partition("-")
+        start = int(start) if start else 0
+        end = min(int(end), len(data) - 1) if end else len(data) - 1
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        data = data[start:end + 1]
+        status = 206
+
+    if request.method == "GET":
+        with _lock:
+            _stats["bytes_sent"] += len(data)
+    headers["Content-Length"] = str(len(data))
+    return Response(data, status=status, headers=headers, mimetype="application/octet-stream")
+
+
+@app.route("/_stub/stats")
+def stub_stats():
+    with _lock:
+        return dict(_stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local S3-compatible stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--latency-ms", type=float, default=0, help="artificial latency of every GET/HEAD")
+    args = parser.parse_args()
+    LATENCY_SECONDS = args.latency_ms / 1000
+    app.run(host=args.host, port=args.port, threaded=True)
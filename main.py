@@ -1,205 +1,1818 @@
-import re
-import os
-import logging
-import boto3
-import tempfile
-import shutil # Добавляем для удаления временных директорий
-from playwright.sync_api import Playwright, sync_playwright, expect, TimeoutError
-import time
-from dotenv import load_dotenv
-from flask import Flask, request, jsonify
-import threading
-
-load_dotenv() # Load environment variables from .env file
-
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-# S3_FILE_KEY will now be passed via API request
-
-# Configure logging to file
-logging.basicConfig(filename='debug.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s', encoding='utf-8')
-
-app = Flask(__name__)
-
-def run_autoclicker_task(s3_file_key: str, identifier: str) -> tuple[dict, int]: # Добавляем identifier
-    temp_dir = None
-    file_path = None
-    try:
-        # Создаем временную директорию
-        temp_dir = tempfile.mkdtemp()
-        file_name = os.path.basename(s3_file_key)
-        file_path = os.path.join(temp_dir, file_name)
-
-        logging.debug(f"Downloading '{s3_file_key}' from S3 bucket '{S3_BUCKET_NAME}' to '{file_path}'")
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            endpoint_url=os.getenv("AWS_S3_ENDPOINT_URL") # Optional: for custom S3 compatible storage
-        )
-        s3.download_file(S3_BUCKET_NAME, s3_file_key, file_path)
-        logging.debug("File downloaded successfully from S3")
-
-        FILE_PATH = file_path
-        name_picture = file_name # Используем оригинальное имя файла
-
-        # Извлекаем issue_number из имени файла (первые 6 символов)
-        issue_number = name_picture[:6]
-        logging.debug(f"Извлечен issue_number: {issue_number}")
-
-        with sync_playwright() as playwright:
-            logging.debug("Launching browser")
-            browser = playwright.chromium.launch(headless=True)
-            # browser = playwright.chromium.launch(headless=False)
-            logging.debug("Browser launched")
-
-            logging.debug("Creating new context")
-            context = browser.new_context()
-            logging.debug("Context created")
-
-            logging.debug("Creating new page")
-            page = context.new_page()
-            logging.debug("Page created")
-
-            logging.debug("Navigating to login page")
-            page.goto("https://newamelia.mvideo.ru/login", timeout=15000)
-            logging.debug("Navigation completed")
-
-            logging.debug("Filling login")
-            page.locator("#login-input").click()
-            page.locator("#login-input").fill(os.getenv("LOGIN_USERNAME"))
-
-            logging.debug("Filling password")
-            page.locator("#password-input").click()
-            page.locator("#password-input").fill(os.getenv("LOGIN_PASSWORD"))
-
-            logging.debug("Clicking login button")
-            page.get_by_role("button", name="Войти").click()
-
-            logging.debug("Clicking nav issues")
-            page.locator("#nav-dynamic_issues").get_by_role("img").click()
-
-            # 🔥 Ждём, пока индикатор загрузки (q-skeleton) исчезнет
-            logging.debug("Waiting for loader to disappear")
-            loader = page.locator("div:nth-child(3) > .q-skeleton.q-mb-sm")
-            loader.wait_for(state='hidden', timeout=10000)  # Ждать
-            logging.debug("Loader disappeared")
-
-            logging.debug("Clicking search textbox")
-            page.get_by_role("textbox", name="Поиск").click()
-            logging.debug(f"Filling search with {issue_number}")
-            page.get_by_role("textbox", name="Поиск").fill(issue_number)
-
-            # Найдите кнопку
-
-            logging.debug("Finding claim number element")
-            claim_number = page.get_by_role("cell", name=issue_number)
-            time.sleep(4)
-            try:
-                box = claim_number.bounding_box()
-                if not box:
-                    logging.error(f"Элемент с issue_number '{issue_number}' не найден или невидим")
-                    # Возвращаем ошибку, указывающую на проблему с issue_number
-                    return {"error": f"Claim with issue number '{issue_number}' not found or invisible", "identifier": identifier}, 400
-            except TimeoutError:
-                logging.error(f"Таймаут при поиске элемента с issue_number '{issue_number}'")
-                return {"error": f"Timeout while searching for claim with issue number '{issue_number}'", "identifier": identifier}, 400
-            except Exception as e:
-                logging.error(f"Произошла ошибка при получении bounding_box для issue_number '{issue_number}': {e}")
-                return {"error": f"Error getting bounding box for claim with issue number '{issue_number}': {e}", "identifier": identifier}, 400
-
-            # Проверяем наличие поля "в работе"
-            if page.locator("text=в работе").is_visible():
-                logging.debug("Поле 'в работе' найдено. Выполняем действия для 'Прибыл на объект'.")
-                # Добавляем статус и клик по "Прибыл на объект"
-                page.get_by_role("row", name=issue_number).get_by_role("img").click()
-                time.sleep(1)
-                page.get_by_text("Прибыл на объект").wait_for(timeout=10000) # Добавляем ожидание
-                page.get_by_text("Прибыл на объект").click()
-                time.sleep(1)
-                logging.debug("Waiting for 'Прибыл на объект' button to appear")
-                page.get_by_role("button", name="Прибыл на объект").wait_for(timeout=10000) # Ожидаем кнопку
-                logging.debug("Clicking 'Прибыл на объект' button")
-                page.get_by_role("button", name="Прибыл на объект").click() # Кликаем по кнопке
-                time.sleep(1) # Задержка по запросу пользователя
-            else:
-                logging.debug("Поле 'в работе' не найдено. Пропускаем действия для 'Прибыл на объект'.")
-
-            logging.debug(f"Координаты элемента: x={box['x']}, y={box['y']}, ширина={box['width']}, высота={box['height']}")
-
-            # 🔥 Расчёт точки клика: немного правее и ниже элемента
-            # Например: +50 пикселей по X (правее), +10 по Y (ниже)
-            click_x = box['x'] + box['width'] - 20   # Правее границы элемента
-            click_y = box['y'] + box['height'] / 2 - 20  # По центру по вертикали, чуть ниже
-
-            # ✅ Кликаем в эту точку
-            logging.debug(f"Clicking at point: ({click_x}, {click_y})")
-            page.mouse.click(click_x, click_y)
-
-            logging.debug(f"✅ Клик выполнен в точку: ({click_x}, {click_y})")
-
-
-            logging.debug("Clicking Comments tab")
-            page.get_by_role("tab", name="Комментарии").click()
-
-            logging.debug("Waiting for upload area to appear")
-            upload_locator = page.locator("#file-field-images")
-            upload_locator.wait_for(timeout=10000)
-            logging.debug("Upload area appeared")
-
-            logging.debug("Setting input files")
-            file_input = page.locator('input[type="file"]')
-            file_input.set_input_files(FILE_PATH)
-            logging.debug(f"📁 Файл '{FILE_PATH}' успешно установлен!")
-
-            # 🔥 ШАГ 3: Дождёмся, пока файл отобразится в интерфейсе (опционально)
-            # В вашем HTML уже есть примеры: <div class="existing-file"> с картинками
-            # file_name_display = os.path.basename(FILE_PATH[:6])
-            page.wait_for_selector(f'span.caption:has-text("{issue_number}")', timeout=10000)
-            logging.debug("✅ Файл отобразился в списке загруженных!")
-
-            logging.debug("Clicking 'Add' button")
-            page.get_by_role("button", name="Добавить").click()
-            logging.debug("Clicking 'Close' button")
-            page.locator(".form-card-close-icon").click()
-            
-            page.get_by_text("Запись успешно обновлена").wait_for(timeout=10000)
-            
-            
-            # logging.debug("Sleeping for 5 seconds")
-            # time.sleep(5)
-
-            # ---------------------
-            logging.debug("Closing context")
-            context.close()
-            logging.debug("Closing browser")
-            browser.close()
-            logging.debug("Browser closed")
-            return {"message": f"Autoclicker task completed successfully for S3_FILE_KEY: {s3_file_key}", "identifier": identifier}, 200 # Успешный возврат
-
-    except Exception as e:
-        logging.error(f"An error occurred during autoclicker task: {e}")
-        return {"error": f"An internal server error occurred: {e}", "identifier": identifier}, 500 # Внутренняя ошибка сервера
-    finally:
-        # Clean up the temporary directory
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            logging.debug(f"Temporary directory '{temp_dir}' deleted.")
-
-@app.route("/run_autoclicker", methods=["POST"])
-def trigger_autoclicker():
-    data = request.get_json()
-    s3_file_key = data.get("s3_file_key")
-    identifier = data.get("identifier") # Получаем новый идентификатор
-
-    if not s3_file_key:
-        return jsonify({"error": "Missing 's3_file_key' in request body", "identifier": identifier}), 400
-    
-    if not identifier:
-        return jsonify({"error": "Missing 'identifier' in request body"}), 400
-
-    # Выполняем задачу напрямую и возвращаем ее результат
-    response_data, status_code = run_autoclicker_task(s3_file_key, identifier) # Передаем identifier
-    return jsonify(response_data), status_code
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+import re
+import os
+import logging
+import boto3
+from botocore.config import Config as BotoConfig
+import tempfile
+import shutil # Добавляем для удаления временных директорий
+from playwright.sync_api import Playwright, sync_playwright, expect, TimeoutError, Error as PlaywrightError
+import time
+import queue
+import atexit
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dotenv import load_dotenv
+from flask import Flask, request, jsonify
+import threading
+import json
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import contextlib
+import uuid
+import hashlib
+import mimetypes
+import sqlite3
+import multiprocessing
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as futures_wait
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+try:
+    import fcntl  # Межпроцессная блокировка логина (Linux/Docker)
+except ImportError:
+    fcntl = None
+
+load_dotenv() # Load environment variables from .env file
+
+S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+# S3_FILE_KEY will now be passed via API request
+# Размер пула HTTP-соединений общего S3-клиента и число параллельных скачиваний
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "20"))
+S3_DOWNLOAD_WORKERS = int(os.getenv("S3_DOWNLOAD_WORKERS", "8"))
+# Локальный кэш файлов по ETag (пусто - без кэша) и его максимальный размер
+S3_CACHE_DIR = os.getenv("S3_CACHE_DIR", "")
+S3_CACHE_MAX_MB = int(os.getenv("S3_CACHE_MAX_MB", "512"))
+
+AMELIA_BASE_URL = os.getenv("AMELIA_BASE_URL", "https://newamelia.mvideo.ru").rstrip("/")
+# Файл с авторизованной сессией (storage_state Playwright), общий для всех воркеров
+SESSION_STATE_PATH = os.getenv("SESSION_STATE_PATH", "session_state.json")
+# Часть URL запроса поиска заявок: если задана, шаг поиска дополнительно ждёт ответа сервера
+AMELIA_SEARCH_RESPONSE_PATTERN = os.getenv("AMELIA_SEARCH_RESPONSE_PATTERN")
+
+# Быстрый путь через backend API портала (APIRequestContext с той же сессией) с откатом на UI.
+# Пути - относительно AMELIA_BASE_URL или полные URL; в AMELIA_API_ATTACH_URL подставляется {issue_id}
+AMELIA_API_MODE = os.getenv("AMELIA_API_MODE", "0") == "1"
+AMELIA_API_ISSUES_URL = os.getenv("AMELIA_API_ISSUES_URL", "")
+AMELIA_API_ATTACH_URL = os.getenv("AMELIA_API_ATTACH_URL", "")
+AMELIA_API_ENABLED = AMELIA_API_MODE and bool(AMELIA_API_ISSUES_URL and AMELIA_API_ATTACH_URL)
+AMELIA_API_SEARCH_PARAM = os.getenv("AMELIA_API_SEARCH_PARAM", "search")
+# Поля ответа поиска: список заявок, номер, id и статус заявки
+AMELIA_API_ITEMS_FIELD = os.getenv("AMELIA_API_ITEMS_FIELD", "items")
+AMELIA_API_ISSUE_NUMBER_FIELD = os.getenv("AMELIA_API_ISSUE_NUMBER_FIELD", "number")
+AMELIA_API_ISSUE_ID_FIELD = os.getenv("AMELIA_API_ISSUE_ID_FIELD", "id")
+AMELIA_API_STATUS_FIELD = os.getenv("AMELIA_API_STATUS_FIELD", "status")
+# Поля multipart-запроса загрузки вложения (поле комментария необязательно)
+AMELIA_API_FILE_FIELD = os.getenv("AMELIA_API_FILE_FIELD", "images")
+AMELIA_API_COMMENT_FIELD = os.getenv("AMELIA_API_COMMENT_FIELD", "")
+# Ключ localStorage с токеном авторизации, если backend ждёт заголовок Authorization
+AMELIA_API_TOKEN_STORAGE_KEY = os.getenv("AMELIA_API_TOKEN_STORAGE_KEY", "")
+AMELIA_API_TOKEN_PREFIX = os.getenv("AMELIA_API_TOKEN_PREFIX", "Bearer ")
+AMELIA_API_TIMEOUT = int(os.getenv("AMELIA_API_TIMEOUT", "5000"))  # мс
+
+# Сколько мс таблица заявок должна оставаться пустой, чтобы считать, что заявки нет.
+# С AMELIA_SEARCH_RESPONSE_PATTERN ответ поиска уже получен и ждать нужно только отрисовку
+EMPTY_TABLE_SETTLE_MS = int(os.getenv("EMPTY_TABLE_SETTLE_MS", "300" if AMELIA_SEARCH_RESPONSE_PATTERN else "1500"))
+
+# Пул браузеров: N заранее запущенных Chromium, каждый живёт в своём потоке
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "2"))
+BROWSER_HEADLESS = os.getenv("BROWSER_HEADLESS", "1") != "0"
+# Перезапуск браузера после K задач (0 - без ограничения)
+BROWSER_MAX_TASKS = int(os.getenv("BROWSER_MAX_TASKS", "50"))
+# Перезапуск браузера, если суммарный RSS его процессов превысил порог в МБ (0 - не проверять)
+BROWSER_MAX_RSS_MB = int(os.getenv("BROWSER_MAX_RSS_MB", "1024"))
+# Как часто простаивающий воркер проверяет, что браузер жив (секунды)
+BROWSER_HEALTHCHECK_INTERVAL = float(os.getenv("BROWSER_HEALTHCHECK_INTERVAL", "30"))
+# RSS браузера (CDP + /proc) проверяется при простое и перед каждой N-й задачей (0 - только при простое)
+BROWSER_RSS_CHECK_EVERY = int(os.getenv("BROWSER_RSS_CHECK_EVERY", "10"))
+# Сколько секунд после дедлайна ждать, пока начатая задача сама остановится и вернёт результат
+BROWSER_DEADLINE_GRACE = float(os.getenv("BROWSER_DEADLINE_GRACE", "30"))
+
+# Очередь фоновых задач (POST /run_autoclicker с "async": true)
+# Число процессов-исполнителей (0 - выполнять задачи в этом процессе)
+JOB_PROCESSES = int(os.getenv("JOB_PROCESSES", "0"))
+# Сколько задач выполняется одновременно. Процесс-исполнитель выполняет одну задачу за раз,
+# поэтому в режиме процессов задач не больше JOB_PROCESSES, а в каждом процессе один браузер
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(JOB_PROCESSES or BROWSER_POOL_SIZE)))
+# Максимальная глубина очереди, сверх неё отвечаем 429
+JOB_QUEUE_MAX_DEPTH = int(os.getenv("JOB_QUEUE_MAX_DEPTH", "100"))
+# Таймаут выполнения одной задачи в секундах (0 - без ограничения)
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "300"))
+# Сколько задач хранить для GET /jobs/<job_id>
+JOB_HISTORY_LIMIT = int(os.getenv("JOB_HISTORY_LIMIT", "1000"))
+
+# Идемпотентность по (identifier, s3_file_key): где хранить успешные результаты и сколько (0 - не хранить)
+IDEMPOTENCY_DB_PATH = os.getenv("IDEMPOTENCY_DB_PATH", "idempotency.sqlite3")
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+
+# Логи: файл с ротацией по размеру
+LOG_FILE = os.getenv("LOG_FILE", "debug.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Каталог для Playwright trace упавших заявок (пусто - не записывать).
+# Не бесплатно: пока включено, скриншоты и DOM-снимки пишутся для каждой заявки, в том числе успешной,
+# что замедляет шаги и расходует CPU и временный диск; на диск сохраняется только кусок упавшей заявки.
+# Включать на время разбора ошибок
+TRACE_ON_FAILURE_DIR = os.getenv("TRACE_ON_FAILURE_DIR", "")
+
+
+# Логи пишутся через очередь: потоки задач не ждут диска, запись и ротацию делает отдельный поток.
+# В каждую запись добавляется identifier текущего запроса.
+current_identifier = contextvars.ContextVar("current_identifier", default="-")
+
+
+class IdentifierFilter(logging.Filter):
+    def filter(self, record):
+        record.identifier = current_identifier.get()
+        return True
+
+
+_log_queue = queue.Queue(-1)
+_log_file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+_log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - [%(identifier)s] %(message)s'))
+_log_listener = QueueListener(_log_queue, _log_file_handler)
+
+
+def _setup_logging(log_queue):
+    handler = QueueHandler(log_queue)
+    handler.addFilter(IdentifierFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+
+if multiprocessing.parent_process() is None:
+    # В дочерних процессах JobQueue логирование настраивает инициализатор пула
+    _setup_logging(_log_queue)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+app = Flask(__name__)
+
+
+class Metrics:
+    # Минимальный реестр метрик в текстовом формате Prometheus: счётчики и гистограммы с метками.
+    # Дочерние процессы JobQueue отдают накопленные значения через drain(), родитель - merge().
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [counts по бакетам, sum, count]
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def drain(self) -> dict:
+        with self._lock:
+            data = {"counters": self._counters, "histograms": self._histograms}
+            self._counters, self._histograms = {}, {}
+        return data
+
+    def merge(self, data: dict):
+        with self._lock:
+            for key, value in data["counters"].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (counts, total, count) in data["histograms"].items():
+                histogram = self._histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    @staticmethod
+    def _labels(labels, extra: tuple = ()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self, gauges: dict, totals: dict = None) -> str:
+        # gauges: {name: (help, value)} - текущие значения, вычисляемые в момент запроса;
+        # totals - то же для счётчиков, которые ведут сами пулы и кэши (только растут, имена *_total)
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in counters:
+                if metric == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), (counts, total, count) in histograms:
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(self.BUCKETS, counts):
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {bucket_count}")
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for metric_type, snapshot in (("counter", totals or {}), ("gauge", gauges)):
+            for name, (help_text, value) in snapshot.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRIC_HELP = {
+    "ameliya_step_duration_seconds": "Duration of a single workflow step (including retries)",
+    "ameliya_task_duration_seconds": "Duration of a whole autoclicker task",
+    "ameliya_tasks_total": "Processed files by outcome: success, not_found, timeout, internal",
+}
+
+metrics = Metrics()
+
+
+def _record_outcome(outcome: str, count: int = 1):
+    metrics.inc("ameliya_tasks_total", count, outcome=outcome)
+
+
+def _deadline(timeout: float = None) -> Optional[float]:
+    # Дедлайн задачи по time.monotonic(); отсчёт идёт с момента, когда задача начала выполняться
+    return time.monotonic() + timeout if timeout else None
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    # Сколько секунд осталось до дедлайна (None - без ограничения)
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def _cap_timeout(timeout_ms: int, deadline: Optional[float]) -> int:
+    # Таймаут вызова Playwright в мс, не выходящий за дедлайн задачи (0 в Playwright - "без таймаута")
+    if deadline is None:
+        return timeout_ms
+    return max(1, min(timeout_ms, int(_remaining(deadline) * 1000)))
+
+
+def _failure_type(error: Exception) -> str:
+    if isinstance(error, StepError):
+        return error.kind
+    if isinstance(error, (TimeoutError, FutureTimeoutError)):
+        return "timeout"
+    return "internal"
+
+
+
+def _browser_rss_mb(browser) -> float:
+    # Суммарный RSS всех процессов Chromium (browser, renderer, gpu, ...) по данным /proc
+    session = browser.new_browser_cdp_session()
+    try:
+        info = session.send("SystemInfo.getProcessInfo")
+    finally:
+        session.detach()
+    total_kb = 0
+    for process in info.get("processInfo", []):
+        try:
+            with open(f"/proc/{process['id']}/status", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total_kb / 1024
+
+
+class BrowserWorker(threading.Thread):
+    # Sync API Playwright не потокобезопасен, поэтому каждый воркер сам владеет
+    # своим экземпляром Playwright и браузером и выполняет задачи только в своём потоке.
+
+    def __init__(self, pool: "BrowserPool", index: int):
+        super().__init__(name=f"browser-worker-{index}", daemon=True)
+        self.pool = pool
+        self.browser = None
+        self.alive = False
+        self.tasks_done = 0
+        self.restarts = 0
+
+    def _launch(self, playwright: Playwright):
+        self._close_browser()
+        logging.debug(f"[{self.name}] Launching browser")
+        self.browser = playwright.chromium.launch(headless=BROWSER_HEADLESS)
+        self.tasks_done = 0
+        self.alive = True
+        logging.debug(f"[{self.name}] Browser launched")
+
+    def _close_browser(self):
+        self.alive = False
+        if self.browser is None:
+            return
+        try:
+            self.browser.close()
+        except Exception as e:
+            logging.warning(f"[{self.name}] Error while closing browser: {e}")
+        self.browser = None
+
+    def _restart_reason(self, check_memory: bool):
+        if self.browser is None or not self.browser.is_connected():
+            return "browser is not running"
+        if BROWSER_MAX_TASKS and self.tasks_done >= BROWSER_MAX_TASKS:
+            return f"served {self.tasks_done} tasks"
+        if BROWSER_MAX_RSS_MB and check_memory:
+            try:
+                rss_mb = _browser_rss_mb(self.browser)
+            except Exception as e:
+                return f"health check failed: {e}"
+            if rss_mb > BROWSER_MAX_RSS_MB:
+                return f"RSS {rss_mb:.0f} MB exceeds {BROWSER_MAX_RSS_MB} MB"
+        return None
+
+    def _ensure_browser(self, playwright: Playwright, check_memory: bool):
+        reason = self._restart_reason(check_memory)
+        if reason:
+            if self.browser is not None:
+                logging.info(f"[{self.name}] Restarting browser: {reason}")
+                self.restarts += 1
+            self._launch(playwright)
+
+    def run(self):
+        while True:
+            try:
+                with sync_playwright() as playwright:
+                    self._serve(playwright)
+                    return
+            except Exception as e:
+                # Драйвер Playwright не запустился или упал. Поток не завершаем - пул его бы не заменил
+                logging.error(f"[{self.name}] Playwright driver failed: {e}")
+                self.alive = False
+                self.browser = None
+                if not self._fail_next_task(e):
+                    return
+
+    def _fail_next_task(self, error: Exception) -> bool:
+        # Пока драйвер не поднят, задачи получают ошибку сразу, а не ждут его восстановления.
+        # False - пул остановлен
+        try:
+            item = self.pool._tasks.get(timeout=BROWSER_HEALTHCHECK_INTERVAL)
+        except queue.Empty:
+            return True
+        if item is None:
+            return False
+        _, future = item
+        if future.set_running_or_notify_cancel():
+            future.set_exception(error)
+        return True
+
+    def _serve(self, playwright: Playwright):
+        try:
+            self._launch(playwright)
+        except Exception as e:
+            # Повторим запуск при получении первой задачи
+            logging.error(f"[{self.name}] Failed to launch browser: {e}")
+
+        while True:
+            try:
+                item = self.pool._tasks.get(timeout=BROWSER_HEALTHCHECK_INTERVAL)
+            except queue.Empty:
+                # Память проверяем при простое, а перед задачами - только каждую BROWSER_RSS_CHECK_EVERY-ю
+                try:
+                    self._ensure_browser(playwright, check_memory=True)
+                except Exception as e:
+                    logging.error(f"[{self.name}] Failed to restart browser: {e}")
+                continue
+
+            if item is None:
+                break
+
+            fn, future = item
+            if not future.set_running_or_notify_cancel():
+                # Вызывающий уже перестал ждать (таймаут) - задачу не выполняем
+                continue
+            try:
+                check_memory = BROWSER_RSS_CHECK_EVERY > 0 and self.tasks_done > 0 and self.tasks_done % BROWSER_RSS_CHECK_EVERY == 0
+                self._ensure_browser(playwright, check_memory)
+                result = fn(self.browser)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                self.tasks_done += 1
+                if self.browser is not None and not self.browser.is_connected():
+                    logging.warning(f"[{self.name}] Browser crashed during task")
+                    self.alive = False
+
+        self._close_browser()
+
+
+class BrowserPool:
+    # Долгоживущий пул браузеров. Задачи получают браузер из пула и сами создают в нём
+    # свежий контекст, поэтому между задачами не остаётся cookies и открытых страниц.
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._tasks = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Вызывается перед каждой задачей, поэтому заодно заменяет воркеры, чей поток завершился
+        with self._lock:
+            first_start = not self._workers
+            workers = list(self._workers) or [None] * self.size
+            for index, worker in enumerate(workers):
+                if worker is not None and worker.is_alive():
+                    continue
+                replacement = BrowserWorker(self, index)
+                if worker is not None:
+                    logging.error(f"[{worker.name}] Worker thread exited, starting a new one")
+                    replacement.restarts = worker.restarts  # счётчик рестартов не должен уменьшаться
+                replacement.start()
+                workers[index] = replacement
+            self._workers = workers
+            if first_start:
+                logging.debug(f"Browser pool started with {self.size} workers")
+
+    def submit(self, fn) -> Future:
+        # Ставит fn(browser) в очередь воркеров
+        self.start()
+        future = Future()
+        # Контекст вызывающего потока (identifier для логов) переносим в поток воркера
+        task_context = contextvars.copy_context()
+        self._tasks.put((lambda browser: task_context.run(fn, browser), future))
+        return future
+
+    def wait(self, future: Future, deadline: float = None):
+        # Задача, не начатая к дедлайну, отменяется. Начатую останавливает сам run_steps,
+        # поэтому ждём её собственный результат - иначе браузер продолжит работу после ответа 504.
+        # FutureTimeoutError: задача отменена, либо не уложилась в дедлайн с запасом BROWSER_DEADLINE_GRACE.
+        try:
+            return future.result(timeout=_remaining(deadline))
+        except FutureTimeoutError:
+            if future.cancel():
+                raise
+        return future.result(timeout=BROWSER_DEADLINE_GRACE)
+
+    def run(self, fn, deadline: float = None):
+        # Выполняет fn(browser) в одном из воркеров и возвращает её результат
+        return self.wait(self.submit(fn), deadline)
+
+    def stop(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._tasks.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+
+    def stats(self) -> dict:
+        workers = list(self._workers)
+        return {
+            "size": self.size,
+            "browsers_alive": sum(1 for w in workers if w.alive),
+            "queued_tasks": self._tasks.qsize(),
+            "restarts": sum(w.restarts for w in workers),
+        }
+
+
+browser_pool = BrowserPool(BROWSER_POOL_SIZE)
+atexit.register(browser_pool.stop)
+
+
+@dataclass
+class Step:
+    # Один шаг сценария: действие над локатором и сигнал, по которому шаг считается выполненным.
+    # locator(page, ctx) -> Locator, value(ctx) -> значение для fill/set_input_files/goto,
+    # wait(page, ctx, timeout) ждёт конкретного события вместо time.sleep,
+    # response(response, ctx) -> bool - дождаться ответа сервера на действие,
+    # when(page, ctx) -> bool - шаг выполняется только при выполнении условия.
+    name: str
+    action: str  # "goto" | "click" | "fill" | "set_input_files" | "wait"
+    locator: Optional[Callable] = None
+    value: Optional[Callable] = None
+    wait: Optional[Callable] = None
+    response: Optional[Callable] = None
+    when: Optional[Callable] = None
+    timeout: int = 10000
+    retries: int = 0
+    retry_delay: float = 0.5
+    # Текст и HTTP-код ошибки, если шаг не удался после всех попыток (форматируется из ctx)
+    error: Optional[str] = None
+    status_code: int = 500
+    # False - шаг после фиксации изменений в портале: дедлайн задачи его не прерывает,
+    # иначе клиент получит 504 за уже приложенные файлы и повторит запрос
+    interruptible: bool = True
+
+
+class StepError(Exception):
+    def __init__(self, step: str, message: str, status_code: int = 500, kind: str = "internal"):
+        super().__init__(message)
+        self.step = step
+        self.status_code = status_code
+        self.kind = kind  # тип ошибки для метрик: not_found, timeout, internal
+
+
+def _perform_step(page, step: Step, ctx: dict, timeout: int):
+    locator = step.locator(page, ctx) if step.locator else None
+    value = step.value(ctx) if step.value else None
+
+    def act():
+        if step.action == "goto":
+            page.goto(value, timeout=timeout)
+        elif step.action == "click":
+            locator.click(timeout=timeout)
+        elif step.action == "fill":
+            locator.fill(value, timeout=timeout)
+        elif step.action == "set_input_files":
+            locator.set_input_files(value, timeout=timeout)
+        elif step.action != "wait":
+            raise ValueError(f"Unknown step action '{step.action}'")
+
+    if step.response:
+        with page.expect_response(lambda response: step.response(response, ctx), timeout=timeout):
+            act()
+    else:
+        act()
+    if step.wait:
+        step.wait(page, ctx, timeout)
+
+
+def _step_timeout(step: Step, deadline: Optional[float]) -> int:
+    if not step.interruptible or deadline is None:
+        return step.timeout
+    if _remaining(deadline) <= 0:
+        raise StepError(step.name, f"Task deadline exceeded before step '{step.name}'", 504, "timeout")
+    return _cap_timeout(step.timeout, deadline)
+
+
+def run_steps(page, steps: list, ctx: dict, deadline: float = None):
+    # Выполняет шаги по порядку; шаг, не дождавшийся своего сигнала, повторяется step.retries раз.
+    # deadline (time.monotonic()) проверяется перед каждой попыткой и ограничивает её таймаут
+    for step in steps:
+        if step.when and not step.when(page, ctx):
+            logging.debug(f"Step '{step.name}' skipped")
+            continue
+        with metrics.timer("ameliya_step_duration_seconds", step=step.name):
+            for attempt in range(step.retries + 1):
+                try:
+                    timeout = _step_timeout(step, deadline)
+                    logging.debug(f"Step '{step.name}' started")
+                    _perform_step(page, step, ctx, timeout)
+                    logging.debug(f"Step '{step.name}' done")
+                    break
+                except PlaywrightError as e:
+                    if attempt < step.retries:
+                        logging.warning(f"Step '{step.name}' failed (attempt {attempt + 1}/{step.retries + 1}): {e}")
+                        time.sleep(step.retry_delay)
+                        continue
+                    message = step.error.format(**ctx) if step.error else f"Step '{step.name}' failed: {e}"
+                    logging.error(message)
+                    if step.status_code == 400:
+                        kind = "not_found"
+                    elif isinstance(e, TimeoutError):
+                        kind = "timeout"
+                    else:
+                        kind = "internal"
+                    raise StepError(step.name, message, step.status_code, kind) from e
+
+
+def _wait_for(get_locator, state: str = "visible"):
+    # Условие шага: локатор перешёл в нужное состояние
+    def wait(page, ctx, timeout):
+        get_locator(page, ctx).wait_for(state=state, timeout=timeout)
+    return wait
+
+
+def _wait_all(*waits):
+    def wait(page, ctx, timeout):
+        for condition in waits:
+            condition(page, ctx, timeout)
+    return wait
+
+
+def _wait_table_settled(page, ctx: dict, timeout: int):
+    # Таблица заявок отфильтрована: все видимые строки относятся к заявке, либо таблица пуста.
+    # Пустая таблица засчитывается, только если остаётся пустой EMPTY_TABLE_SETTLE_MS: SPA может
+    # очистить строки до того, как отрисует пришедший ответ поиска
+    page.locator(LOADER_SELECTOR).wait_for(state="hidden", timeout=timeout)
+    page.wait_for_function(
+        """({q, token, settleMs}) => {
+            const rows = Array.from(document.querySelectorAll('tbody tr'));
+            if (rows.length > 0) {
+                window.__ameliyaEmptySince = null;
+                return rows.every(row => row.innerText.includes(q));
+            }
+            if (!window.__ameliyaEmptySince || window.__ameliyaEmptySince.token !== token) {
+                window.__ameliyaEmptySince = {token, at: performance.now()};
+            }
+            return performance.now() - window.__ameliyaEmptySince.at >= settleMs;
+        }""",
+        arg={"q": ctx["issue_number"], "token": uuid.uuid4().hex, "settleMs": EMPTY_TABLE_SETTLE_MS},
+        timeout=timeout,
+    )
+    if page.locator("tbody tr").count() == 0:
+        # Поиск честно ничего не нашёл - повторять шаг бессмысленно
+        message = f"Claim with issue number '{ctx['issue_number']}' not found or invisible"
+        logging.error(message)
+        raise StepError("search", message, 400, "not_found")
+
+
+class SessionCache:
+    # Кэш авторизованной сессии (cookies + localStorage) в формате storage_state Playwright.
+    # Лежит в файле, поэтому переиспользуется всеми воркерами, процессами и после рестарта.
+    # Версия сессии - mtime файла: по ней воркер понимает, что сессию уже обновил кто-то другой.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._login_lock = threading.Lock()
+        self._state = None
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _file_version(self) -> int:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return 0
+
+    def get(self) -> tuple:
+        # Возвращает (storage_state или None, версия)
+        with self._lock:
+            version = self._file_version()
+            if version != self._version:
+                try:
+                    with open(self.path, encoding="utf-8") as f:
+                        self._state = json.load(f)
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Failed to read session cache '{self.path}': {e}")
+                    self._state = None
+                self._version = version
+            return self._state, self._version
+
+    def save(self, state: dict):
+        # Пишем атомарно и с правами 0600 - в файле лежат cookies авторизации
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+        logging.debug(f"Session state saved to '{self.path}'")
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    @contextlib.contextmanager
+    def login_lock(self):
+        # Логинится только один воркер (в т.ч. из разных процессов), остальные ждут и берут его сессию
+        with self._login_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(f"{self.path}.lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "cached": self._state is not None}
+
+
+session_cache = SessionCache(SESSION_STATE_PATH)
+
+
+def _is_login_page(page, deadline: float = None) -> bool:
+    # Ждём, пока SPA отрисует либо приложение, либо форму входа
+    page.locator("#nav-dynamic_issues, #login-input").first.wait_for(timeout=_cap_timeout(15000, deadline))
+    return "/login" in page.url or page.locator("#login-input").is_visible()
+
+
+LOGIN_STEPS = [
+    Step("goto_login", "goto", value=lambda ctx: f"{AMELIA_BASE_URL}/login",
+         wait=_wait_for(lambda page, ctx: page.locator("#login-input")),
+         when=lambda page, ctx: "/login" not in page.url, timeout=15000, retries=1),
+    Step("fill_login", "fill", locator=lambda page, ctx: page.locator("#login-input"),
+         value=lambda ctx: os.getenv("LOGIN_USERNAME")),
+    Step("fill_password", "fill", locator=lambda page, ctx: page.locator("#password-input"),
+         value=lambda ctx: os.getenv("LOGIN_PASSWORD")),
+    # Сохранять storage_state можно только после того, как приложение записало токены
+    Step("submit_login", "click", locator=lambda page, ctx: page.get_by_role("button", name="Войти"),
+         wait=_wait_for(lambda page, ctx: page.locator("#nav-dynamic_issues")), timeout=15000,
+         error="Login to Amelia failed"),
+]
+
+
+def _login(page, deadline: float = None):
+    run_steps(page, LOGIN_STEPS, {}, deadline)
+    logging.debug("Logged in")
+
+
+def _open_authenticated_page(browser, deadline: float = None) -> tuple:
+    # Создаёт контекст с закэшированной сессией; логинится только если её нет или она истекла
+    while True:
+        if deadline is not None and _remaining(deadline) <= 0:
+            raise StepError("open_session", "Task deadline exceeded before opening the portal", 504, "timeout")
+        state, version = session_cache.get()
+        logging.debug("Creating new context")
+        context = browser.new_context(storage_state=state) if state else browser.new_context()
+        if TRACE_ON_FAILURE_DIR:
+            # Первый кусок trace - открытие сессии и первая заявка, дальше по куску на заявку
+            context.tracing.start(screenshots=True, snapshots=True)
+        try:
+            page = context.new_page()
+            if state:
+                page.goto(f"{AMELIA_BASE_URL}/", timeout=_cap_timeout(15000, deadline))
+                if not _is_login_page(page, deadline):
+                    session_cache.record_hit()
+                    logging.debug("Reused cached session")
+                    return context, page
+                logging.info("Cached session expired (redirected to /login), re-authenticating")
+
+            with session_cache.login_lock():
+                if session_cache.get()[1] != version:
+                    # Пока ждали блокировку, другой воркер уже обновил сессию - берём её
+                    context.close()
+                    continue
+                session_cache.record_miss()
+                _login(page, deadline)
+                session_cache.save(context.storage_state())
+                return context, page
+        except Exception:
+            _finish_trace(context, failed=True)
+            context.close()
+            raise
+
+
+def _trace_path(label: str) -> str:
+    os.makedirs(TRACE_ON_FAILURE_DIR, exist_ok=True)
+    name = re.sub(r"[^\w.-]", "_", f"{current_identifier.get()}-{label}")
+    return os.path.join(TRACE_ON_FAILURE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}.zip")
+
+
+def _finish_trace(context, failed: bool, label: str = "session"):
+    # Останавливает trace контекста; на диск пишет только текущий кусок и только при ошибке
+    if not TRACE_ON_FAILURE_DIR:
+        return
+    try:
+        if not failed:
+            context.tracing.stop()
+            return
+        path = _trace_path(label)
+        context.tracing.stop(path=path)
+        logging.info(f"Playwright trace of the failed task saved to '{path}'")
+    except Exception as e:
+        logging.warning(f"Failed to stop tracing: {e}")
+
+
+def _next_trace_chunk(context, failed: bool, label: str):
+    # Завершает кусок trace одной заявки (сохраняя его, если она упала) и начинает следующий
+    if not TRACE_ON_FAILURE_DIR:
+        return
+    try:
+        if failed:
+            path = _trace_path(label)
+            context.tracing.stop_chunk(path=path)
+            logging.info(f"Playwright trace of the failed claim saved to '{path}'")
+        else:
+            context.tracing.stop_chunk()
+        context.tracing.start_chunk()
+    except Exception as e:
+        logging.warning(f"Failed to rotate trace chunk: {e}")
+
+
+def _in_work(page, ctx: dict) -> bool:
+    # Проверяем наличие поля "в работе" один раз на заявку
+    if "in_work" not in ctx:
+        ctx["in_work"] = page.locator("text=в работе").first.is_visible()
+        logging.debug(f"Поле 'в работе' {'найдено' if ctx['in_work'] else 'не найдено'}")
+    return ctx["in_work"]
+
+
+def _search_response(response, ctx: dict) -> bool:
+    return AMELIA_SEARCH_RESPONSE_PATTERN in response.url
+
+
+LOADER_SELECTOR = "div:nth-child(3) > .q-skeleton.q-mb-sm"
+
+ISSUES_STEPS = [
+    # 🔥 Ждём, пока индикатор загрузки (q-skeleton) исчезнет и появится поле поиска
+    Step("open_issues", "click", locator=lambda page, ctx: page.locator("#nav-dynamic_issues").get_by_role("img"),
+         wait=_wait_all(
+             _wait_for(lambda page, ctx: page.get_by_role("textbox", name="Поиск")),
+             _wait_for(lambda page, ctx: page.locator(LOADER_SELECTOR), state="hidden"),
+         ),
+         retries=1),
+]
+
+CLAIM_STEPS = [
+    Step("search", "fill", locator=lambda page, ctx: page.get_by_role("textbox", name="Поиск"),
+         value=lambda ctx: ctx["issue_number"],
+         response=_search_response if AMELIA_SEARCH_RESPONSE_PATTERN else None,
+         wait=_wait_table_settled, retries=1,
+         error="Claim with issue number '{issue_number}' not found or invisible", status_code=400),
+    # Добавляем статус "Прибыл на объект", если заявка "в работе"
+    Step("open_status_menu", "click",
+         locator=lambda page, ctx: page.get_by_role("row", name=ctx["issue_number"]).get_by_role("img"),
+         wait=_wait_for(lambda page, ctx: page.get_by_text("Прибыл на объект")),
+         when=_in_work, retries=1),
+    Step("choose_arrived", "click", locator=lambda page, ctx: page.get_by_text("Прибыл на объект"),
+         wait=_wait_for(lambda page, ctx: page.get_by_role("button", name="Прибыл на объект")),
+         when=_in_work),
+    Step("confirm_arrived", "click", locator=lambda page, ctx: page.get_by_role("button", name="Прибыл на объект"),
+         wait=_wait_for(lambda page, ctx: page.get_by_role("button", name="Прибыл на объект"), state="hidden"),
+         when=_in_work),
+    # Открываем карточку кликом по ячейке с номером, без расчёта координат
+    Step("open_claim", "click", locator=lambda page, ctx: page.get_by_role("cell", name=ctx["issue_number"]).first,
+         wait=_wait_for(lambda page, ctx: page.get_by_role("tab", name="Комментарии")), retries=2),
+    Step("open_comments", "click", locator=lambda page, ctx: page.get_by_role("tab", name="Комментарии"),
+         wait=_wait_for(lambda page, ctx: page.locator("#file-field-images")), retries=1),
+    # Все файлы заявки одним set_input_files; ждём, пока каждый отобразится в списке загруженных
+    Step("attach_files", "set_input_files", locator=lambda page, ctx: page.locator('input[type="file"]'),
+         value=lambda ctx: [_resolve_path(f, ctx["deadline"]) for f in ctx["files"]],
+         wait=_wait_for(lambda page, ctx: page.locator(
+             f'span.caption:has-text("{ctx["issue_number"]}")').nth(len(ctx["files"]) - 1))),
+    Step("submit", "click", locator=lambda page, ctx: page.get_by_role("button", name="Добавить")),
+    # Файлы уже приложены - закрытие карточки дедлайн задачи не прерывает
+    Step("close_claim", "click", locator=lambda page, ctx: page.locator(".form-card-close-icon"),
+         wait=_wait_for(lambda page, ctx: page.get_by_text("Запись успешно обновлена")), interruptible=False),
+]
+
+
+def _open_issues(page, deadline: float = None):
+    run_steps(page, ISSUES_STEPS, {}, deadline)
+
+
+def _process_claim(page, issue_number: str, files: list, identifier: str, deadline: float = None) -> tuple[dict, int]:
+    # Находит заявку в списке и прикладывает к ней все файлы одним set_input_files.
+    # files - пути или Future с путём (скачивание из S3 ещё идёт).
+    # Ожидает, что открыт список заявок; после успешного выполнения карточка заявки закрыта.
+    # Неудавшийся шаг бросает StepError с HTTP-кодом ответа.
+    run_steps(page, CLAIM_STEPS, {"issue_number": issue_number, "files": files, "deadline": deadline}, deadline)
+    logging.debug(f"✅ Файлы ({len(files)}) приложены к заявке {issue_number}")
+    return {"message": f"Files attached to claim {issue_number}", "identifier": identifier}, 200
+
+
+def _close_context(context):
+    # Браузер остаётся в пуле, закрываем только контекст задачи
+    logging.debug("Closing context")
+    try:
+        context.close()
+    except Exception as e:
+        logging.warning(f"Error while closing context: {e}")
+    logging.debug("Context closed")
+
+
+def _resolve_path(file, deadline: float = None) -> str:
+    # Путь к файлу или Future фонового скачивания из S3
+    return file.result(timeout=_remaining(deadline)) if isinstance(file, Future) else file
+
+
+def _success(s3_file_key: str, identifier: str) -> tuple[dict, int]:
+    return {"message": f"Autoclicker task completed successfully for S3_FILE_KEY: {s3_file_key}", "identifier": identifier}, 200 # Успешный возврат
+
+
+class _ApiFallback(Exception):
+    # Быстрый путь через API не сработал; files - ещё не загруженные файлы [(s3_file_key, file)]
+    def __init__(self, message: str, files: list):
+        super().__init__(message)
+        self.files = files
+
+
+api_stats = {"succeeded": 0, "fallbacks": 0}
+_api_stats_lock = threading.Lock()
+
+
+def _count_api(outcome: str):
+    with _api_stats_lock:
+        api_stats[outcome] += 1
+
+
+def _api_url(path: str) -> str:
+    return path if path.startswith("http") else f"{AMELIA_BASE_URL}/{path.lstrip('/')}"
+
+
+def _api_headers(state: dict) -> dict:
+    # Токен SPA хранится в localStorage - берём его прямо из закэшированного storage_state
+    if not AMELIA_API_TOKEN_STORAGE_KEY:
+        return {}
+    for origin in state.get("origins", []):
+        if origin.get("origin", "").rstrip("/") != AMELIA_BASE_URL:
+            continue
+        for item in origin.get("localStorage", []):
+            if item.get("name") == AMELIA_API_TOKEN_STORAGE_KEY:
+                return {"Authorization": f"{AMELIA_API_TOKEN_PREFIX}{item['value']}"}
+    return {}
+
+
+def _api_attach(api_request, headers: dict, issue_number: str, files: list, deadline: float = None):
+    # Ищет заявку и загружает файлы напрямую в backend портала, без отрисовки страниц.
+    # Бросает _ApiFallback с оставшимися файлами, если что-то пошло не так.
+    try:
+        response = api_request.get(
+            _api_url(AMELIA_API_ISSUES_URL), params={AMELIA_API_SEARCH_PARAM: issue_number},
+            headers=headers, timeout=_cap_timeout(AMELIA_API_TIMEOUT, deadline),
+        )
+        if not response.ok:
+            raise _ApiFallback(f"issue search returned HTTP {response.status}", files)
+        payload = response.json()
+    except (PlaywrightError, ValueError) as e:
+        raise _ApiFallback(f"issue search failed: {e}", files) from e
+
+    try:
+        items = payload if isinstance(payload, list) else payload.get(AMELIA_API_ITEMS_FIELD) or []
+        issue = next((item for item in items if str(item.get(AMELIA_API_ISSUE_NUMBER_FIELD)) == issue_number), None)
+        if issue is None:
+            raise _ApiFallback(f"claim {issue_number} not found via API", files)
+        if AMELIA_API_STATUS_FIELD and "в работе" in str(issue.get(AMELIA_API_STATUS_FIELD, "")).lower():
+            # Смену статуса на "Прибыл на объект" выполняет только UI-сценарий
+            raise _ApiFallback(f"claim {issue_number} is 'в работе'", files)
+        attach_url = _api_url(AMELIA_API_ATTACH_URL.format(issue_id=issue[AMELIA_API_ISSUE_ID_FIELD]))
+    except (AttributeError, TypeError, KeyError, IndexError, ValueError) as e:
+        # Ответ не того формата или неверный шаблон AMELIA_API_ATTACH_URL - справится UI-сценарий
+        raise _ApiFallback(f"unexpected issue search response or attach URL: {e!r}", files) from e
+    remaining = list(files)
+    while remaining:
+        if deadline is not None and _remaining(deadline) <= 0:
+            raise _ApiFallback("task deadline exceeded", remaining)
+        path = _resolve_path(remaining[0][1], deadline)
+        with open(path, "rb") as f:
+            multipart = {
+                AMELIA_API_FILE_FIELD: {
+                    "name": os.path.basename(path),
+                    "mimeType": mimetypes.guess_type(path)[0] or "application/octet-stream",
+                    "buffer": f.read(),
+                },
+            }
+        if AMELIA_API_COMMENT_FIELD:
+            multipart[AMELIA_API_COMMENT_FIELD] = ""
+        try:
+            response = api_request.post(
+                attach_url, multipart=multipart, headers=headers, timeout=_cap_timeout(AMELIA_API_TIMEOUT, deadline)
+            )
+        except PlaywrightError as e:
+            raise _ApiFallback(f"attachment upload failed: {e}", remaining) from e
+        if not response.ok:
+            raise _ApiFallback(f"attachment upload returned HTTP {response.status}", remaining)
+        remaining.pop(0)
+    logging.debug(f"✅ Файлы ({len(files)}) приложены к заявке {issue_number} через API")
+
+
+class ClaimSession:
+    # Сессия обработки заявок в одном браузере. Сначала пробует быстрый путь через API портала
+    # (AMELIA_API_MODE), при неудаче - UI-сценарий. API-контекст и страница создаются лениво.
+
+    def __init__(self, browser, deadline: float = None):
+        self.browser = browser
+        self.deadline = deadline
+        self.api_context = None
+        self.api_headers = {}
+        self.context = None
+        self.page = None
+        self.issues_open = False
+
+    def _api_request(self):
+        if self.api_context is None:
+            state, _ = session_cache.get()
+            if not state:
+                # Сессии ещё нет - её создаст UI-сценарий, API попробуем для следующих заявок
+                return None
+            self.api_context = self.browser.new_context(storage_state=state)
+            self.api_headers = _api_headers(state)
+        return self.api_context.request
+
+    def _ui_page(self):
+        if self.page is None:
+            self.context, self.page = _open_authenticated_page(self.browser, self.deadline)
+            logging.debug("Context created")
+        elif not self.issues_open:
+            # После ошибки страница могла остаться с открытой карточкой - начинаем с главной
+            self.page.goto(f"{AMELIA_BASE_URL}/", timeout=_cap_timeout(15000, self.deadline))
+        if not self.issues_open:
+            _open_issues(self.page, self.deadline)
+            self.issues_open = True
+        return self.page
+
+    def attach(self, issue_number: str, files: list, identifier: str) -> dict:
+        # files - [(s3_file_key, путь или Future)]; возвращает {s3_file_key: (dict, status)}
+        results = {}
+        outcome = "success"
+        used_ui = False
+        try:
+            api_request = self._api_request() if AMELIA_API_ENABLED else None
+            if api_request is not None:
+                try:
+                    with metrics.timer("ameliya_step_duration_seconds", step="api_attach"):
+                        _api_attach(api_request, self.api_headers, issue_number, files, self.deadline)
+                    _count_api("succeeded")
+                    _record_outcome("success", len(files))
+                    return {s3_file_key: _success(s3_file_key, identifier) for s3_file_key, _ in files}
+                except _ApiFallback as e:
+                    _count_api("fallbacks")
+                    logging.warning(f"API mode failed for claim {issue_number}: {e}. Falling back to UI")
+                    for s3_file_key, _ in files[:len(files) - len(e.files)]:
+                        results[s3_file_key] = _success(s3_file_key, identifier)
+                    _record_outcome("success", len(results))
+                    files = e.files
+                    # Cookies или токен могли устареть: UI перелогинится, API возьмёт новую сессию
+                    self._close_api()
+
+            used_ui = True
+            page = self._ui_page()
+            # Скачивания из S3 шли параллельно со входом и открытием списка заявок. Дожидаемся их
+            # до шагов заявки: иначе при ошибке скачивания статус "Прибыл на объект" уже был бы выставлен
+            paths = [_resolve_path(file, self.deadline) for _, file in files]
+            _process_claim(page, issue_number, paths, identifier, self.deadline)
+            response_data, status_code = None, 200
+        except StepError as e:
+            response_data, status_code, outcome = {"error": str(e), "identifier": identifier}, e.status_code, e.kind
+        except FutureTimeoutError:
+            # Файл из S3 не скачался до дедлайна задачи
+            logging.error(f"Task deadline exceeded while waiting for files of claim {issue_number}")
+            response_data, status_code = {"error": "Task deadline exceeded while downloading files from S3", "identifier": identifier}, 504
+            outcome = "timeout"
+        except Exception as e:
+            logging.error(f"Error while processing claim {issue_number}: {e}")
+            response_data, status_code = {"error": f"An internal server error occurred: {e}", "identifier": identifier}, 500
+            outcome = _failure_type(e)
+
+        if status_code != 200:
+            self.issues_open = False
+        if used_ui and self.context is not None:
+            # Если упало само открытие сессии, его trace уже сохранил _open_authenticated_page
+            _next_trace_chunk(self.context, failed=status_code != 200, label=issue_number)
+        _record_outcome(outcome, len(files))
+        for s3_file_key, _ in files:
+            results[s3_file_key] = _success(s3_file_key, identifier) if status_code == 200 else (response_data, status_code)
+        return results
+
+    def _close_api(self):
+        if self.api_context is not None:
+            _close_context(self.api_context)
+            self.api_context = None
+
+    def close(self):
+        self._close_api()
+        if self.context is not None:
+            # Куски упавших заявок уже сохранены, остаток trace не нужен
+            _finish_trace(self.context, failed=False)
+            _close_context(self.context)
+
+
+def _autoclicker_flow(browser, download: Future, s3_file_key: str, issue_number: str, identifier: str,
+                      deadline: float, temp_dir: str) -> tuple[dict, int]:
+    # Выполняется в потоке воркера пула: браузер уже запущен, создаём только свежий контекст.
+    # Файл к этому моменту может ещё скачиваться - его дожидаемся после открытия списка заявок.
+    # Временную директорию удаляет сам воркер: вызывающий мог уже перестать ждать.
+    session = ClaimSession(browser, deadline)
+    try:
+        return session.attach(issue_number, [(s3_file_key, download)], identifier)[s3_file_key]
+    finally:
+        session.close()
+        _remove_task_dir(temp_dir, [download])
+
+
+def _batch_flow(browser, claims: OrderedDict, identifier: str, results: dict, deadline: float, temp_dir: str, downloads: list):
+    # Одна сессия на весь пакет: заявки обрабатываются по очереди, ошибка одной заявки
+    # не прерывает остальные. results заполняется по мере выполнения: {s3_file_key: (dict, status)}
+    session = ClaimSession(browser, deadline)
+    try:
+        for issue_number, files in claims.items():
+            # Пока шла работа с предыдущими заявками, файлы этой уже скачивались
+            ready = []
+            for s3_file_key, download in files:
+                try:
+                    ready.append((s3_file_key, download.result(timeout=_remaining(deadline))))
+                except FutureTimeoutError:
+                    logging.error(f"Task deadline exceeded while downloading '{s3_file_key}'")
+                    results[s3_file_key] = {"error": "Task deadline exceeded while downloading file from S3", "identifier": identifier}, 504
+                    _record_outcome("timeout")
+                except Exception as e:
+                    logging.error(f"Failed to download '{s3_file_key}': {e}")
+                    results[s3_file_key] = {"error": f"Failed to download file from S3: {e}", "identifier": identifier}, 500
+                    _record_outcome("internal")
+            if not ready:
+                continue
+
+            logging.debug(f"Processing claim {issue_number} with {len(ready)} files")
+            results.update(session.attach(issue_number, ready, identifier))
+    finally:
+        session.close()
+        _remove_task_dir(temp_dir, downloads)
+
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def _get_s3_client():
+    # Один клиент на процесс: boto3-клиенты потокобезопасны и держат пул соединений
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                "s3",
+                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                endpoint_url=os.getenv("AWS_S3_ENDPOINT_URL"), # Optional: for custom S3 compatible storage
+                config=BotoConfig(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+            )
+        return _s3_client
+
+
+class S3FileCache:
+    # Локальный LRU-кэш файлов из S3 с ключом по ETag (т.е. по содержимому).
+    # Файл задачи - жёсткая ссылка на объект кэша, поэтому вытеснение не ломает идущие задачи.
+    # Удобно держать на tmpfs, например S3_CACHE_DIR=/dev/shm/ameliya-s3-cache.
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.enabled = bool(cache_dir)
+        self.objects_dir = os.path.join(cache_dir, "objects") if self.enabled else None
+        # Временные директории задач - на той же ФС, что и кэш, чтобы работали жёсткие ссылки
+        self.tasks_dir = os.path.join(cache_dir, "tasks") if self.enabled else None
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(self.objects_dir, exist_ok=True)
+            os.makedirs(self.tasks_dir, exist_ok=True)
+
+    def fetch(self, s3_file_key: str, file_path: str) -> str:
+        s3 = _get_s3_client()
+        if not self.enabled:
+            logging.debug(f"Downloading '{s3_file_key}' from S3 bucket '{S3_BUCKET_NAME}' to '{file_path}'")
+            s3.download_file(S3_BUCKET_NAME, s3_file_key, file_path)
+            logging.debug("File downloaded successfully from S3")
+            return file_path
+
+        etag = s3.head_object(Bucket=S3_BUCKET_NAME, Key=s3_file_key)["ETag"].strip('"')
+        name = hashlib.sha256(etag.encode("utf-8")).hexdigest()
+        cached_path = os.path.join(self.objects_dir, name)
+        try:
+            # Сначала ссылка в директорию задачи: после неё вытеснение объекта файлу задачи не мешает
+            self._link(cached_path, file_path)
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                os.utime(cached_path)  # отмечаем использование для LRU
+            except OSError:
+                pass  # объект уже вытеснили, файл задачи остался
+            with self._lock:
+                self.hits += 1
+            logging.debug(f"S3 cache hit for '{s3_file_key}' (ETag {etag})")
+            return file_path
+
+        with self._lock:
+            self.misses += 1
+        logging.debug(f"Downloading '{s3_file_key}' from S3 bucket '{S3_BUCKET_NAME}' into cache")
+        tmp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        # IfMatch: если объект успели перезаписать после head_object, не кладём чужое содержимое под этот ETag
+        body = s3.get_object(Bucket=S3_BUCKET_NAME, Key=s3_file_key, IfMatch=etag)["Body"]
+        try:
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(body, f, 1024 * 1024)
+            self._link(tmp_path, file_path)
+            os.replace(tmp_path, cached_path)
+        finally:
+            body.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logging.debug("File downloaded successfully from S3")
+        self._evict(keep=name)
+        return file_path
+
+    @staticmethod
+    def _link(source: str, file_path: str):
+        # Жёсткая ссылка, а если кэш на другой ФС - копия. FileNotFoundError - объекта в кэше нет
+        try:
+            os.link(source, file_path)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(source, file_path)
+
+    def _evict(self, keep: str):
+        # keep - только что записанный объект: его не вытесняем, даже если он один больше лимита
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.objects_dir):
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.objects_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                try:
+                    os.remove(os.path.join(self.objects_dir, name))
+                    total -= size
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"enabled": self.enabled, "hits": self.hits, "misses": self.misses}
+
+
+s3_cache = S3FileCache(S3_CACHE_DIR, S3_CACHE_MAX_MB * 1024 * 1024)
+s3_executor = ThreadPoolExecutor(max_workers=S3_DOWNLOAD_WORKERS, thread_name_prefix="s3-download")
+
+
+def _fetch_timed(s3_file_key: str, file_path: str) -> str:
+    with metrics.timer("ameliya_step_duration_seconds", step="s3_download"):
+        return s3_cache.fetch(s3_file_key, file_path)
+
+
+def _start_download(s3_file_key: str, file_path: str) -> Future:
+    # Скачивание идёт в фоне параллельно с логином и навигацией в браузере
+    return s3_executor.submit(contextvars.copy_context().run, _fetch_timed, s3_file_key, file_path)
+
+
+def _discard_downloads(downloads: list):
+    # Перед удалением временной директории убеждаемся, что в неё больше никто не пишет
+    for download in downloads:
+        if not download.cancel():
+            futures_wait([download])
+
+
+def _remove_task_dir(temp_dir: str, downloads: list):
+    # Вызывается и воркером, и вызывающим потоком - повторный вызов ничего не делает
+    _discard_downloads(downloads)
+    if temp_dir and os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        logging.debug(f"Temporary directory '{temp_dir}' deleted.")
+
+
+def run_autoclicker_task(s3_file_key: str, identifier: str, timeout: float = None) -> tuple[dict, int]: # Добавляем identifier
+    current_identifier.set(identifier)
+    with metrics.timer("ameliya_task_duration_seconds", kind="single"):
+        return _run_autoclicker_task(s3_file_key, identifier, timeout)
+
+
+def _run_autoclicker_task(s3_file_key: str, identifier: str, timeout: float = None) -> tuple[dict, int]:
+    deadline = _deadline(timeout)
+    temp_dir = None
+    download = None
+    future = None
+    try:
+        # Создаем временную директорию
+        temp_dir = tempfile.mkdtemp(dir=s3_cache.tasks_dir)
+        file_name = os.path.basename(s3_file_key)
+        file_path = os.path.join(temp_dir, file_name)
+
+        download = _start_download(s3_file_key, file_path)
+
+        name_picture = file_name # Используем оригинальное имя файла
+
+        # Извлекаем issue_number из имени файла (первые 6 символов)
+        issue_number = name_picture[:6]
+        logging.debug(f"Извлечен issue_number: {issue_number}")
+
+        # Браузер берём из пула, а не запускаем на каждый запрос
+        future = browser_pool.submit(
+            lambda browser: _autoclicker_flow(browser, download, s3_file_key, issue_number, identifier, deadline, temp_dir)
+        )
+        return browser_pool.wait(future, deadline)
+
+    except FutureTimeoutError:
+        logging.error(f"Autoclicker task for '{s3_file_key}' timed out after {timeout} seconds")
+        if future.cancelled():
+            # Иначе исход запишет сам воркер, когда остановится
+            _record_outcome("timeout")
+        return {"error": f"Autoclicker task timed out after {timeout} seconds", "identifier": identifier}, 504
+    except Exception as e:
+        logging.error(f"An error occurred during autoclicker task: {e}")
+        _record_outcome(_failure_type(e))
+        return {"error": f"An internal server error occurred: {e}", "identifier": identifier}, 500 # Внутренняя ошибка сервера
+    finally:
+        # Пока задача выполняется в воркере, директорию удалит он сам
+        if future is None or future.done():
+            _remove_task_dir(temp_dir, [download] if download is not None else [])
+
+
+def run_autoclicker_batch_task(s3_file_keys: list, identifier: str, timeout: float = None) -> tuple[dict, int]:
+    current_identifier.set(identifier)
+    with metrics.timer("ameliya_task_duration_seconds", kind="batch"):
+        return _run_autoclicker_batch_task(s3_file_keys, identifier, timeout)
+
+
+def _run_autoclicker_batch_task(s3_file_keys: list, identifier: str, timeout: float = None) -> tuple[dict, int]:
+    # Пакетная обработка: файлы группируются по issue_number (первые 6 символов имени),
+    # каждая заявка открывается один раз, все её файлы прикладываются одним действием.
+    deadline = _deadline(timeout)
+    results = {}
+    claims = OrderedDict()
+    keys = list(OrderedDict.fromkeys(s3_file_keys))  # без дубликатов, с сохранением порядка
+    temp_dir = tempfile.mkdtemp(dir=s3_cache.tasks_dir)
+    downloads = []
+    replayed = set()
+    future = None
+    try:
+        # Запускаем все скачивания сразу, браузер в это время логинится
+        for index, s3_file_key in enumerate(keys):
+            stored = idempotency.get((identifier, s3_file_key))
+            if stored:
+                # Файл уже был приложен к заявке ранее - повторно не загружаем
+                results[s3_file_key] = stored
+                replayed.add(s3_file_key)
+                continue
+            file_name = os.path.basename(s3_file_key)
+            # Отдельная поддиректория на ключ: одинаковые имена файлов из разных папок не пересекутся
+            file_path = os.path.join(temp_dir, str(index), file_name)
+            os.makedirs(os.path.dirname(file_path))
+            download = _start_download(s3_file_key, file_path)
+            downloads.append(download)
+            claims.setdefault(file_name[:6], []).append((s3_file_key, download))
+        logging.debug(f"Batch for '{identifier}': {len(claims)} claims, {len(keys)} keys")
+
+        try:
+            if claims:
+                future = browser_pool.submit(
+                    lambda browser: _batch_flow(browser, claims, identifier, results, deadline, temp_dir, downloads)
+                )
+                browser_pool.wait(future, deadline)
+        except FutureTimeoutError:
+            logging.error(f"Batch task for '{identifier}' timed out after {timeout} seconds")
+            error = {"error": f"Autoclicker task timed out after {timeout} seconds", "identifier": identifier}, 504
+            # Не отменённая задача ещё выполняется и сама запишет исходы обработанных файлов
+            failure = "timeout" if future.cancelled() else None
+        except Exception as e:
+            logging.error(f"An error occurred during batch task: {e}")
+            error = {"error": f"An internal server error occurred: {e}", "identifier": identifier}, 500
+            failure = _failure_type(e)
+        else:
+            error = None
+        if error:
+            # Ключи, до которых не дошла очередь, помечаем общей ошибкой сессии
+            for s3_file_key in keys:
+                if s3_file_key not in results:
+                    results[s3_file_key] = error
+                    if failure:
+                        _record_outcome(failure)
+    finally:
+        # Пока задача выполняется в воркере, директорию удалит он сам
+        if future is None or future.done():
+            _remove_task_dir(temp_dir, downloads)
+
+    items = []
+    for s3_file_key in keys:
+        result, status_code = results[s3_file_key]
+        if s3_file_key not in replayed:
+            idempotency.put((identifier, s3_file_key), result, status_code)
+        items.append({"s3_file_key": s3_file_key, "status_code": status_code, **result})
+    all_succeeded = all(item["status_code"] == 200 for item in items)
+    # 207: часть файлов не обработана, подробности - в results
+    return {"identifier": identifier, "results": items}, 200 if all_succeeded else 207
+
+
+class IdempotencyStore:
+    # Идемпотентность по ключу (identifier, s3_file_key): повтор запроса, пока оригинал ещё
+    # выполняется, ждёт его результата, а успешные результаты хранятся в SQLite в течение TTL
+    # и отдаются сразу, без браузера и без повторного вложения файла в заявку.
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._connection = None
+        self._inflight = {}
+        self.replays = 0
+        self.coalesced = 0
+
+    def _connect(self):
+        # Соединение открываем лениво: файл БД не нужен, пока нет ни одного запроса
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "identifier TEXT NOT NULL, s3_file_key TEXT NOT NULL, status_code INTEGER NOT NULL, "
+                "response TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (identifier, s3_file_key))"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def get(self, key: tuple):
+        # Возвращает сохранённый (dict, status) или None
+        if not self.ttl_seconds:
+            return None
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT response, status_code FROM results WHERE identifier = ? AND s3_file_key = ? AND created_at > ?",
+                (*key, time.time() - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                return None
+            self.replays += 1
+        logging.debug(f"Returning stored result for {key}")
+        return json.loads(row[0]), row[1]
+
+    def put(self, key: tuple, response_data: dict, status_code: int):
+        # Сохраняем только успешные результаты: ошибки клиент вправе повторить
+        if not self.ttl_seconds or not 200 <= status_code < 300:
+            return
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO results (identifier, s3_file_key, status_code, response, created_at) VALUES (?, ?, ?, ?, ?)",
+                (*key, status_code, json.dumps(response_data, ensure_ascii=False), time.time()),
+            )
+            connection.execute("DELETE FROM results WHERE created_at <= ?", (time.time() - self.ttl_seconds,))
+            connection.commit()
+
+    def run(self, key: tuple, fn) -> tuple[dict, int]:
+        # Выполняет fn() не более одного раза на ключ одновременно
+        stored = self.get(key)
+        if stored:
+            return stored
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+        if not owner:
+            logging.debug(f"Duplicate request for {key}, waiting for the in-flight execution")
+            return future.result()
+
+        try:
+            # Оригинал мог завершиться между проверкой хранилища и регистрацией в _inflight
+            result = self.get(key) or fn()
+            self.put(key, *result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"replays": self.replays, "coalesced": self.coalesced, "in_flight": len(self._inflight)}
+
+
+idempotency = IdempotencyStore(IDEMPOTENCY_DB_PATH, IDEMPOTENCY_TTL_SECONDS)
+
+
+class JobQueue:
+    # Очередь фоновых задач с ограниченной глубиной. Задачи выполняют JOB_WORKERS потоков:
+    # либо прямо в этом процессе (через пул браузеров), либо в пуле из JOB_PROCESSES процессов,
+    # у каждого из которых свой пул браузеров - так пропускная способность растёт с числом ядер.
+
+    def __init__(self, workers: int, max_depth: int, processes: int):
+        self.processes = processes
+        # Лишние потоки в режиме процессов только ждали бы свободный процесс
+        self.workers = max(1, min(workers, processes) if processes > 0 else workers)
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._executor = None
+        self._log_queue = None
+        self._log_listener = None
+        self._active = {}  # idempotency_key -> job_id поставленной или выполняющейся задачи
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            if self.processes > 0:
+                # spawn, а не fork: в родителе уже работают потоки и, возможно, Playwright
+                mp_context = multiprocessing.get_context("spawn")
+                # Дочерние процессы шлют записи логов в общую очередь, в файл пишет только родитель
+                self._log_queue = mp_context.Queue(-1)
+                self._log_listener = QueueListener(self._log_queue, _log_file_handler)
+                self._log_listener.start()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=mp_context,
+                    initializer=_init_worker_process,
+                    initargs=(self._log_queue,),
+                )
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            logging.debug(f"Job queue started with {self.workers} workers, {self.processes} processes")
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._log_listener is not None:
+            self._log_listener.stop()
+
+    def submit(self, func, args: tuple, identifier: str, callback_url: str = None, idempotency_key: tuple = None) -> dict:
+        # Бросает queue.Full, если очередь заполнена.
+        # С idempotency_key повтор уже поставленной задачи возвращает существующую задачу,
+        # а для сохранённого результата сразу создаётся завершённая задача.
+        self.start()
+        stored = idempotency.get(idempotency_key) if idempotency_key else None
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "identifier": identifier,
+            "status": "queued",
+            "status_code": None,
+            "result": None,
+            "callback_url": callback_url,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        if stored:
+            result, status_code = stored
+            job.update(status="completed", status_code=status_code, result=result, started_at=job["created_at"], finished_at=job["created_at"])
+        # Проверка дубликата, постановка в очередь и регистрация ключа - под одной блокировкой,
+        # иначе два одновременных повтора оба не найдут друг друга и займут два места в очереди
+        with self._lock:
+            active_job_id = self._active.get(idempotency_key) if idempotency_key else None
+            if active_job_id:
+                logging.debug(f"Duplicate job for {idempotency_key}, returning job {active_job_id}")
+                return dict(self._jobs[active_job_id])
+            if not stored:
+                self._queue.put_nowait((job_id, func, args, idempotency_key))  # queue.Full - до регистрации задачи
+                if idempotency_key:
+                    self._active[idempotency_key] = job_id
+            self._jobs[job_id] = job
+            self._trim_history()
+            job = dict(job)
+        if stored:
+            if callback_url:
+                _send_webhook(job)
+            return job
+        logging.debug(f"Job {job_id} queued for identifier '{identifier}'")
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {
+            "workers": self.workers,
+            "processes": self.processes,
+            "depth": self.depth(),
+            "max_depth": self._queue.maxsize,
+            "jobs": {status: statuses.count(status) for status in set(statuses)},
+        }
+
+    def _trim_history(self):
+        # Храним не больше JOB_HISTORY_LIMIT задач, выбрасывая самые старые завершённые
+        excess = len(self._jobs) - JOB_HISTORY_LIMIT
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job["finished_at"]][:excess]:
+            del self._jobs[job_id]
+
+    def _update(self, job_id: str, **fields) -> dict:
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            return dict(job)
+
+    def _execute(self, func, args: tuple, identifier: str) -> tuple[dict, int]:
+        if self._executor is None:
+            return func(*args, timeout=JOB_TIMEOUT_SECONDS)
+        future = self._executor.submit(_run_in_worker_process, func, args, JOB_TIMEOUT_SECONDS)
+        try:
+            # Дедлайн отсчитывается в дочернем процессе с начала задачи, и по нему процесс сам вернёт 504.
+            # Здесь только страховка от зависшего процесса, с запасом на его запуск
+            result, worker_metrics = future.result(
+                timeout=JOB_TIMEOUT_SECONDS + BROWSER_DEADLINE_GRACE + 60 if JOB_TIMEOUT_SECONDS else None
+            )
+            metrics.merge(worker_metrics)
+            return result
+        except FutureTimeoutError:
+            future.cancel()
+            return {"error": f"Job timed out after {JOB_TIMEOUT_SECONDS} seconds", "identifier": identifier}, 504
+
+    def _worker(self):
+        while True:
+            job_id, func, args, idempotency_key = self._queue.get()
+            job = self._update(job_id, status="running", started_at=time.time())
+            current_identifier.set(job["identifier"])
+            try:
+                if idempotency_key:
+                    # Синхронный запрос с тем же ключом мог уже выполняться - ждём его, а не запускаем браузер
+                    result, status_code = idempotency.run(idempotency_key, lambda: self._execute(func, args, job["identifier"]))
+                else:
+                    result, status_code = self._execute(func, args, job["identifier"])
+            except Exception as e:
+                logging.error(f"Job {job_id} failed: {e}")
+                result, status_code = {"error": f"An internal server error occurred: {e}"}, 500
+            finally:
+                if idempotency_key:
+                    with self._lock:
+                        self._active.pop(idempotency_key, None)
+            job = self._update(
+                job_id,
+                status="completed" if status_code < 400 else "failed",
+                status_code=status_code,
+                result=result,
+                finished_at=time.time(),
+            )
+            logging.debug(f"Job {job_id} finished with status {status_code}")
+            if job["callback_url"]:
+                # Не в потоке задачи: медленный callback не должен занимать место исполнителя
+                _send_webhook(job)
+
+
+def _init_worker_process(log_queue):
+    _setup_logging(log_queue)
+    # Процесс получает следующую задачу только после завершения текущей - второй браузер не нужен
+    browser_pool.size = 1
+
+
+def _run_in_worker_process(func, args: tuple, timeout: float) -> tuple:
+    # Метрики дочернего процесса возвращаются вместе с результатом и сливаются в родительские
+    return func(*args, timeout=timeout), metrics.drain()
+
+
+def _send_webhook(job: dict):
+    threading.Thread(target=_notify_webhook, args=(job,), name=f"webhook-{job['job_id']}", daemon=True).start()
+
+
+def _is_valid_callback_url(callback_url) -> bool:
+    if not isinstance(callback_url, str):
+        return False
+    parsed = urllib.parse.urlparse(callback_url)
+    return parsed.scheme in ("http", "https") and bool(parsed.netloc)
+
+
+def _notify_webhook(job: dict):
+    payload = json.dumps(job, ensure_ascii=False).encode("utf-8")
+    webhook_request = urllib.request.Request(
+        job["callback_url"], data=payload, headers={"Content-Type": "application/json"}, method="POST"
+    )
+    try:
+        with urllib.request.urlopen(webhook_request, timeout=10) as response:
+            logging.debug(f"Webhook for job {job['job_id']} delivered: HTTP {response.status}")
+    except Exception as e:
+        logging.error(f"Failed to deliver webhook for job {job['job_id']} to '{job['callback_url']}': {e}")
+
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_MAX_DEPTH, JOB_PROCESSES)
+atexit.register(job_queue.stop)
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "browser_pool": browser_pool.stats(),
+        "session_cache": session_cache.stats(),
+        "job_queue": job_queue.stats(),
+        "s3_cache": s3_cache.stats(),
+        "api_mode": {"enabled": AMELIA_API_ENABLED, **api_stats},
+        "idempotency": idempotency.stats(),
+    }), 200
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    # Счётчики и гистограммы копятся в metrics, текущие значения пулов и кэшей снимаются на момент запроса.
+    # В режиме JOB_PROCESSES браузерные показатели относятся только к родительскому процессу.
+    pool = browser_pool.stats()
+    sessions = session_cache.stats()
+    files = s3_cache.stats()
+    replays = idempotency.stats()
+    gauges = {
+        "ameliya_job_queue_depth": ("Jobs waiting in the background queue", job_queue.depth()),
+        "ameliya_browser_pool_size": ("Configured number of browsers", pool["size"]),
+        "ameliya_browsers_alive": ("Browsers currently running", pool["browsers_alive"]),
+        "ameliya_browser_queued_tasks": ("Tasks waiting for a free browser", pool["queued_tasks"]),
+    }
+    totals = {
+        "ameliya_browser_restarts_total": ("Browser restarts since start", pool["restarts"]),
+        "ameliya_session_cache_hits_total": ("Tasks that reused the saved portal session", sessions["hits"]),
+        "ameliya_session_cache_misses_total": ("Tasks that had to log in", sessions["misses"]),
+        "ameliya_s3_cache_hits_total": ("S3 downloads served from the disk cache", files["hits"]),
+        "ameliya_s3_cache_misses_total": ("S3 downloads fetched from the bucket", files["misses"]),
+        "ameliya_api_succeeded_total": ("Attachments done through the backend API", api_stats["succeeded"]),
+        "ameliya_api_fallbacks_total": ("API attempts that fell back to the UI", api_stats["fallbacks"]),
+        "ameliya_idempotency_replays_total": ("Requests answered from the idempotency store", replays["replays"]),
+        "ameliya_idempotency_coalesced_total": ("Requests that waited for an identical in-flight task", replays["coalesced"]),
+    }
+    return metrics.render(gauges, totals), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": f"Job '{job_id}' not found"}), 404
+    return jsonify(job), 200
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": f"Job '{job_id}' not found"}), 404
+    if not job["finished_at"]:
+        # Задача ещё не завершена
+        return jsonify({"job_id": job_id, "status": job["status"], "identifier": job["identifier"]}), 202
+    return jsonify(job["result"]), job["status_code"]
+
+def _enqueue(func, args: tuple, identifier: str, callback_url: str = None, idempotency_key: tuple = None):
+    # Ставим задачу в очередь и сразу возвращаем job_id
+    if callback_url is not None and not _is_valid_callback_url(callback_url):
+        return jsonify({"error": "'callback_url' must be an http(s) URL", "identifier": identifier}), 400
+    try:
+        job = job_queue.submit(func, args, identifier, callback_url, idempotency_key)
+    except queue.Full:
+        logging.warning(f"Job queue is full, rejecting request for identifier '{identifier}'")
+        return jsonify({"error": "Job queue is full, retry later", "identifier": identifier}), 429, {"Retry-After": "5"}
+    # Для уже сохранённого результата задача создаётся сразу завершённой
+    return jsonify({"job_id": job["job_id"], "status": job["status"], "identifier": identifier}), 200 if job["finished_at"] else 202
+
+@app.route("/run_autoclicker", methods=["POST"])
+def trigger_autoclicker():
+    data = request.get_json()
+    s3_file_key = data.get("s3_file_key")
+    identifier = data.get("identifier") # Получаем новый идентификатор
+
+    if not s3_file_key:
+        return jsonify({"error": "Missing 's3_file_key' in request body", "identifier": identifier}), 400
+    
+    if not identifier:
+        return jsonify({"error": "Missing 'identifier' in request body"}), 400
+
+    current_identifier.set(identifier)
+    if data.get("async"):
+        return _enqueue(run_autoclicker_task, (s3_file_key, identifier), identifier, data.get("callback_url"), (identifier, s3_file_key))
+
+    # Выполняем задачу напрямую и возвращаем ее результат; повторы с тем же ключом не запускают браузер заново
+    response_data, status_code = idempotency.run(
+        (identifier, s3_file_key), lambda: run_autoclicker_task(s3_file_key, identifier) # Передаем identifier
+    )
+    return jsonify(response_data), status_code
+
+@app.route("/run_autoclicker_batch", methods=["POST"])
+def trigger_autoclicker_batch():
+    data = request.get_json()
+    s3_file_keys = data.get("s3_file_keys")
+    identifier = data.get("identifier")
+
+    if not s3_file_keys or not isinstance(s3_file_keys, list):
+        return jsonify({"error": "Missing 's3_file_keys' list in request body", "identifier": identifier}), 400
+
+    if not all(isinstance(s3_file_key, str) and s3_file_key for s3_file_key in s3_file_keys):
+        return jsonify({"error": "Every item of 's3_file_keys' must be a non-empty string", "identifier": identifier}), 400
+
+    if not identifier:
+        return jsonify({"error": "Missing 'identifier' in request body"}), 400
+
+    current_identifier.set(identifier)
+    if data.get("async"):
+        return _enqueue(run_autoclicker_batch_task, (s3_file_keys, identifier), identifier, data.get("callback_url"))
+
+    response_data, status_code = run_autoclicker_batch_task(s3_file_keys, identifier)
+    return jsonify(response_data), status_code
+
+if __name__ == "__main__":
+    # Запускаем браузеры заранее, чтобы первый запрос не ждал старта Chromium
+    browser_pool.start()
+    job_queue.start()
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")), threaded=True)
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# main.py читает настройки при импорте: до него уводим лог, сессию и БД идемпотентности во временный каталог
+_tmp_dir = tempfile.mkdtemp(prefix="ameliya-tests-")
+os.environ["LOG_FILE"] = os.path.join(_tmp_dir, "debug.log")
+os.environ["SESSION_STATE_PATH"] = os.path.join(_tmp_dir, "session_state.json")
+os.environ["IDEMPOTENCY_DB_PATH"] = os.path.join(_tmp_dir, "idempotency.sqlite3")
+os.environ["S3_CACHE_DIR"] = ""
+os.environ["JOB_PROCESSES"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
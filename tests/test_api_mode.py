@@ -0,0 +1,52 @@
+import pytest
+
+import main
+
+FILES = [("uploads/123456_a.jpg", "/missing/a.jpg"), ("uploads/123456_b.jpg", "/missing/b.jpg")]
+
+
+class FakeResponse:
+    ok = True
+    status = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeApiRequest:
+    def __init__(self, payload):
+        self.payload = payload
+        self.posts = []
+
+    def get(self, *args, **kwargs):
+        return FakeResponse(self.payload)
+
+    def post(self, *args, **kwargs):
+        self.posts.append(args)
+        return FakeResponse({})
+
+
+@pytest.mark.parametrize("payload", [
+    5,
+    "claims",
+    ["123456"],
+    {"items": [1, 2]},
+    [{"number": "123456"}],  # без id
+])
+def test_malformed_search_response_falls_back_with_all_files(payload):
+    api_request = FakeApiRequest(payload)
+    with pytest.raises(main._ApiFallback) as error:
+        main._api_attach(api_request, {}, "123456", FILES)
+    assert error.value.files == FILES
+    assert api_request.posts == []
+
+
+@pytest.mark.parametrize("attach_url", ["/api/issues/{}/files", "/api/issues/{id}/files", "/api/issues/{issue_id/files"])
+def test_bad_attach_url_template_falls_back_with_all_files(monkeypatch, attach_url):
+    monkeypatch.setattr(main, "AMELIA_API_ATTACH_URL", attach_url)
+    with pytest.raises(main._ApiFallback) as error:
+        main._api_attach(FakeApiRequest([{"number": "123456", "id": 7}]), {}, "123456", FILES)
+    assert error.value.files == FILES
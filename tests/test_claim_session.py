@@ -0,0 +1,32 @@
+from concurrent.futures import Future
+
+import main
+
+
+def test_failed_download_stops_before_claim_steps(monkeypatch):
+    # Ошибка S3 не должна оставлять в портале сменённый статус заявки
+    claim_steps = []
+    monkeypatch.setattr(main, "AMELIA_API_ENABLED", False)
+    monkeypatch.setattr(main.ClaimSession, "_ui_page", lambda self: object())
+    monkeypatch.setattr(main, "_process_claim", lambda *args: claim_steps.append(args))
+    download = Future()
+    download.set_exception(FileNotFoundError("NoSuchKey"))
+
+    results = main.ClaimSession(browser=None).attach("123456", [("uploads/123456.jpg", download)], "order-1")
+
+    assert results["uploads/123456.jpg"][1] == 500
+    assert claim_steps == []
+
+
+def test_claim_steps_get_downloaded_paths(monkeypatch):
+    claim_steps = []
+    monkeypatch.setattr(main, "AMELIA_API_ENABLED", False)
+    monkeypatch.setattr(main.ClaimSession, "_ui_page", lambda self: object())
+    monkeypatch.setattr(main, "_process_claim", lambda page, issue, files, *rest: claim_steps.append(files))
+    download = Future()
+    download.set_result("/tmp/123456.jpg")
+
+    results = main.ClaimSession(browser=None).attach("123456", [("uploads/123456.jpg", download)], "order-1")
+
+    assert results["uploads/123456.jpg"][1] == 200
+    assert claim_steps == [["/tmp/123456.jpg"]]
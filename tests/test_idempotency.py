@@ -0,0 +1,79 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+
+KEY = ("order-1", "uploads/123456_photo.jpg")
+
+
+@pytest.fixture
+def store(tmp_path):
+    return main.IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), ttl_seconds=60)
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition was not met in time"
+        time.sleep(0.01)
+
+
+def test_concurrent_duplicates_run_once(store):
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def attach():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"message": "attached"}, 200
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        original = executor.submit(store.run, KEY, attach)
+        assert started.wait(5)
+        duplicate = executor.submit(store.run, KEY, attach)
+        _wait_until(lambda: store.coalesced == 1)
+        release.set()
+        assert original.result(5) == ({"message": "attached"}, 200)
+        assert duplicate.result(5) == ({"message": "attached"}, 200)
+    assert len(calls) == 1
+
+
+def test_successful_result_is_replayed(store):
+    calls = []
+
+    def attach():
+        calls.append(1)
+        return {"message": "attached"}, 200
+
+    assert store.run(KEY, attach) == ({"message": "attached"}, 200)
+    assert store.run(KEY, attach) == ({"message": "attached"}, 200)
+    assert len(calls) == 1
+    assert store.stats()["replays"] == 1
+
+
+def test_errors_are_not_stored(store):
+    results = iter([({"error": "portal is down"}, 500), ({"message": "attached"}, 200)])
+
+    assert store.run(KEY, lambda: next(results)) == ({"error": "portal is down"}, 500)
+    assert store.get(KEY) is None
+    # Повтор после ошибки снова выполняет задачу
+    assert store.run(KEY, lambda: next(results)) == ({"message": "attached"}, 200)
+
+
+def test_stored_result_expires_after_ttl(store, monkeypatch):
+    store.put(KEY, {"message": "attached"}, 200)
+    assert store.get(KEY) == ({"message": "attached"}, 200)
+
+    now = time.time()
+    monkeypatch.setattr(main.time, "time", lambda: now + 61)
+    assert store.get(KEY) is None
+
+
+def test_zero_ttl_disables_storage(tmp_path):
+    store = main.IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), ttl_seconds=0)
+    store.put(KEY, {"message": "attached"}, 200)
+    assert store.get(KEY) is None
@@ -0,0 +1,122 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def blocked_queue(tmp_path, monkeypatch):
+    # Очередь на одну задачу с одним исполнителем, который ждёт release
+    started, release = threading.Event(), threading.Event()
+
+    def run_task(s3_file_key, identifier, timeout=None):
+        started.set()
+        release.wait(5)
+        return {"message": f"done {s3_file_key}", "identifier": identifier}, 200
+
+    jobs = main.JobQueue(workers=1, max_depth=1, processes=0)
+    monkeypatch.setattr(main, "job_queue", jobs)
+    monkeypatch.setattr(main, "idempotency", main.IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), 60))
+    monkeypatch.setattr(main, "run_autoclicker_task", run_task)
+    yield jobs, started
+    release.set()
+    # Дожидаемся оставшихся задач, пока main.idempotency ещё подменён
+    deadline = time.monotonic() + 5
+    while any(status in jobs.stats()["jobs"] for status in ("queued", "running")):
+        assert time.monotonic() < deadline, "jobs did not finish in time"
+        time.sleep(0.01)
+
+
+def _post(client, s3_file_key):
+    return client.post(
+        "/run_autoclicker", json={"s3_file_key": s3_file_key, "identifier": "order-1", "async": True}
+    )
+
+
+def test_full_queue_returns_429(blocked_queue):
+    _, started = blocked_queue
+    client = main.app.test_client()
+
+    assert _post(client, "123456_a.jpg").status_code == 202
+    assert started.wait(5)  # первая задача выполняется, очередь снова пуста
+    assert _post(client, "123456_b.jpg").status_code == 202
+
+    response = _post(client, "123456_c.jpg")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "5"
+    assert response.get_json()["identifier"] == "order-1"
+
+
+def test_duplicate_key_returns_queued_job(blocked_queue):
+    _, started = blocked_queue
+    client = main.app.test_client()
+
+    running = _post(client, "123456_a.jpg").get_json()
+    assert started.wait(5)
+    # Повтор выполняющейся задачи не занимает место в очереди
+    assert _post(client, "123456_a.jpg").get_json()["job_id"] == running["job_id"]
+    queued = _post(client, "123456_b.jpg").get_json()
+    assert _post(client, "123456_b.jpg").get_json()["job_id"] == queued["job_id"]
+
+
+def test_stored_result_completes_job_immediately(blocked_queue):
+    main.idempotency.put(("order-1", "123456_a.jpg"), {"message": "done 123456_a.jpg"}, 200)
+    client = main.app.test_client()
+
+    response = _post(client, "123456_a.jpg")
+    assert response.status_code == 200
+    job = client.get(f"/jobs/{response.get_json()['job_id']}/result")
+    assert job.status_code == 200
+    assert job.get_json() == {"message": "done 123456_a.jpg"}
+
+
+def test_concurrent_duplicates_share_one_job(blocked_queue, monkeypatch):
+    jobs, _ = blocked_queue
+    stored_lookup = main.idempotency.get
+
+    def slow_lookup(key):
+        # Расширяем окно между проверкой дубликата и регистрацией задачи
+        time.sleep(0.05)
+        return stored_lookup(key)
+
+    monkeypatch.setattr(main.idempotency, "get", slow_lookup)
+    barrier = threading.Barrier(10)
+
+    def submit():
+        barrier.wait(5)
+        return jobs.submit(main.run_autoclicker_task, ("123456_a.jpg", "order-1"), "order-1",
+                           idempotency_key=("order-1", "123456_a.jpg"))["job_id"]
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        job_ids = list(executor.map(lambda _: submit(), range(10)))
+    assert len(set(job_ids)) == 1
+
+
+@pytest.mark.parametrize("callback_url", ["file:///etc/passwd", "ftp://example.com/hook", "example.com/hook", "http://", 42])
+def test_callback_url_must_be_http(blocked_queue, callback_url):
+    response = main.app.test_client().post("/run_autoclicker", json={
+        "s3_file_key": "123456_a.jpg", "identifier": "order-1", "async": True, "callback_url": callback_url,
+    })
+    assert response.status_code == 400
+    assert blocked_queue[0].stats()["jobs"] == {}
+
+
+def test_slow_webhook_does_not_hold_the_worker(tmp_path, monkeypatch):
+    webhook_release = threading.Event()
+    monkeypatch.setattr(main, "_notify_webhook", lambda job: webhook_release.wait(5))
+    monkeypatch.setattr(main, "idempotency", main.IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), 60))
+    jobs = main.JobQueue(workers=1, max_depth=10, processes=0)
+    task = lambda s3_file_key, identifier, timeout=None: ({"message": "done"}, 200)
+    try:
+        first = jobs.submit(task, ("123456_a.jpg", "order-1"), "order-1", callback_url="http://127.0.0.1:9/hook")
+        second = jobs.submit(task, ("123456_b.jpg", "order-1"), "order-1", callback_url="http://127.0.0.1:9/hook")
+        # Единственный исполнитель успевает обе задачи, пока вебхук первой ещё висит
+        deadline = time.monotonic() + 2
+        while not all(jobs.get(job["job_id"])["finished_at"] for job in (first, second)):
+            assert time.monotonic() < deadline, "worker is blocked by the webhook"
+            time.sleep(0.01)
+    finally:
+        webhook_release.set()
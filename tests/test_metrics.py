@@ -0,0 +1,46 @@
+import main
+
+
+def test_render_counters_histograms_and_snapshots():
+    metrics = main.Metrics()
+    metrics.inc("ameliya_tasks_total", outcome="success")
+    metrics.inc("ameliya_tasks_total", 2, outcome="success")
+    metrics.observe("ameliya_step_duration_seconds", 0.3, step="search")
+
+    lines = metrics.render(
+        {"ameliya_job_queue_depth": ("Jobs waiting", 4)},
+        {"ameliya_s3_cache_hits_total": ("Cache hits", 7)},
+    ).splitlines()
+
+    assert "# TYPE ameliya_tasks_total counter" in lines
+    assert 'ameliya_tasks_total{outcome="success"} 3' in lines
+    assert "# TYPE ameliya_step_duration_seconds histogram" in lines
+    assert 'ameliya_step_duration_seconds_bucket{step="search",le="0.25"} 0' in lines
+    assert 'ameliya_step_duration_seconds_bucket{step="search",le="0.5"} 1' in lines
+    assert 'ameliya_step_duration_seconds_bucket{step="search",le="+Inf"} 1' in lines
+    assert 'ameliya_step_duration_seconds_count{step="search"} 1' in lines
+    assert "# TYPE ameliya_s3_cache_hits_total counter" in lines
+    assert "ameliya_s3_cache_hits_total 7" in lines
+    assert "# TYPE ameliya_job_queue_depth gauge" in lines
+    assert "ameliya_job_queue_depth 4" in lines
+
+
+def test_label_values_are_escaped():
+    metrics = main.Metrics()
+    metrics.inc("ameliya_tasks_total", outcome='bad"value\\')
+    assert 'ameliya_tasks_total{outcome="bad\\"value\\\\"} 1' in metrics.render({}).splitlines()
+
+
+def test_drain_and_merge_move_values_between_registries():
+    # Так метрики дочернего процесса JobQueue попадают в родительский реестр
+    child, parent = main.Metrics(), main.Metrics()
+    parent.inc("ameliya_tasks_total", outcome="success")
+    child.inc("ameliya_tasks_total", outcome="success")
+    child.observe("ameliya_task_duration_seconds", 2.0, kind="single")
+
+    parent.merge(child.drain())
+
+    lines = parent.render({}).splitlines()
+    assert 'ameliya_tasks_total{outcome="success"} 2' in lines
+    assert 'ameliya_task_duration_seconds_count{kind="single"} 1' in lines
+    assert child.render({}) == "\n"
@@ -0,0 +1,42 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+
+
+class FakeS3:
+    def head_object(self, Bucket, Key):
+        return {"ETag": f'"{Key}"'}
+
+    def get_object(self, Bucket, Key, IfMatch):
+        return {"Body": io.BytesIO(Key.encode("utf-8") * 100)}
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "_s3_client", FakeS3())
+    # Лимит меньше одного объекта: каждое скачивание вытесняет всё остальное
+    return main.S3FileCache(str(tmp_path / "cache"), max_bytes=10)
+
+
+def test_fetch_returns_file_when_object_exceeds_limit(cache, tmp_path):
+    for attempt in range(2):
+        file_path = str(tmp_path / f"task-{attempt}.jpg")
+        assert cache.fetch("uploads/123456.jpg", file_path) == file_path
+        assert os.path.exists(file_path)
+    assert cache.stats()["hits"] + cache.stats()["misses"] == 2
+
+
+def test_concurrent_fetches_survive_eviction(cache, tmp_path):
+    def fetch(index):
+        s3_file_key = f"uploads/{index % 5}.jpg"
+        file_path = str(tmp_path / f"task-{index}.jpg")
+        cache.fetch(s3_file_key, file_path)
+        with open(file_path, "rb") as f:
+            return f.read() == s3_file_key.encode("utf-8") * 100
+
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        assert all(executor.map(fetch, range(40)))
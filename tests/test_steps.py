@@ -0,0 +1,61 @@
+import pytest
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+import main
+
+SEARCH_STEP = [step for step in main.CLAIM_STEPS if step.name == "search"]
+
+
+class FakeLocator:
+    def __init__(self, page, selector):
+        self.page = page
+        self.selector = selector
+
+    def fill(self, value, timeout):
+        self.page.fills.append(value)
+
+    def wait_for(self, state="visible", timeout=None):
+        pass
+
+    def count(self):
+        return self.page.rows if self.selector == "tbody tr" else 1
+
+
+class FakePage:
+    def __init__(self, rows, settle_error=None):
+        self.rows = rows
+        self.settle_error = settle_error
+        self.fills = []
+
+    def locator(self, selector):
+        return FakeLocator(self, selector)
+
+    def get_by_role(self, role, name=None):
+        return FakeLocator(self, role)
+
+    def wait_for_function(self, expression, arg=None, timeout=None):
+        if self.settle_error:
+            raise self.settle_error
+
+
+def test_empty_search_result_is_not_found_without_retry():
+    page = FakePage(rows=0)
+    with pytest.raises(main.StepError) as error:
+        main.run_steps(page, SEARCH_STEP, {"issue_number": "012345"})
+    assert (error.value.status_code, error.value.kind) == (400, "not_found")
+    assert page.fills == ["012345"]
+
+
+def test_found_claim_passes_search_step():
+    page = FakePage(rows=1)
+    main.run_steps(page, SEARCH_STEP, {"issue_number": "123456"})
+    assert page.fills == ["123456"]
+
+
+def test_playwright_timeout_is_retried(monkeypatch):
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    page = FakePage(rows=1, settle_error=PlaywrightTimeoutError("table did not settle"))
+    with pytest.raises(main.StepError) as error:
+        main.run_steps(page, SEARCH_STEP, {"issue_number": "123456"})
+    assert error.value.status_code == 400
+    assert page.fills == ["123456", "123456"]